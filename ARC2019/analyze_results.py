@@ -1,4 +1,5 @@
 import sys, os, re, glob
+from pathlib import Path
 import numpy as np
 import pandas as pd
 
@@ -60,7 +61,7 @@ if False:
 		with open(data_file, 'r') as f:
 			for line in f:
 				lig_file = os.path.join(data_root, line.split()[3])
-				lig_name = os.path.splitext(os.path.basename(lig_file))[0]
+				lig_name = Path(lig_file).stem
 				lig_xyz, lig_c = read_gninatypes_file(lig_file, channels)
 				lig_xyzs[lig_name] = lig_xyz
 				lig_cs[lig_name] = lig_c
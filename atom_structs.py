@@ -40,6 +40,7 @@ class AtomStruct(object):
             self.radius = np.nan
 
         self.info = info
+        self._type_counts = None
 
     @classmethod
     def from_gninatypes(cls, gtypes_file, channels, **info):
@@ -72,6 +73,18 @@ class AtomStruct(object):
     def n_atoms(self):
         return self.xyz.shape[0]
 
+    def type_counts(self, n_types, dtype=None):
+        '''
+        Count the number of atoms of each of n_types channels,
+        caching the result for repeated calls.
+        '''
+        if self._type_counts is None or len(self._type_counts) != n_types:
+            self._type_counts = np.bincount(self.c, minlength=n_types)
+        counts = self._type_counts
+        if dtype is not None:
+            counts = counts.astype(dtype, copy=False)
+        return counts
+
     def to_ob_mol(self):
         mol = molecules.make_ob_mol(self.xyz.astype(float), self.c, self.bonds, self.channels)
         return mol
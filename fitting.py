@@ -10,12 +10,20 @@ import seaborn as sns
 from rdkit import Geometry
 from skimage.segmentation import flood_fill
 from collections import namedtuple
-from scipy.spatial.distance import pdist
-from scipy.spatial.distance import squareform
+from scipy.spatial import cKDTree
 import pickle
 
 from atom_structs import AtomStruct
 
+#per-element valence limits indexed by atomic number, built once at
+#import so the per-atom loop reduces to numpy gathers; max valence is
+#the smallest allowed by openbabel or rdkit (rdkit is usually lower)
+#since we want the molecule to be valid for both
+_ob_max_bonds = np.array([ob.GetMaxBonds(z) for z in range(119)])
+_rd_default_valence = np.array(
+    [Chem.GetPeriodicTable().GetDefaultValence(z) for z in range(119)]
+)
+
 
 def grid_to_xyz(gcoords, mgrid):
     return mgrid.center+(np.array(gcoords)-((mgrid.size-1)/2))*mgrid.resolution
@@ -312,27 +320,26 @@ def fixup(atoms, mol, struct):
 
 
 
-def reachable_r(a,b, seenbonds):
-    '''Recursive helper.'''
-
-    for nbr in ob.OBAtomAtomIter(a):
-        bond = a.GetBond(nbr).GetIdx()
-        if bond not in seenbonds:
-            seenbonds.add(bond)
-            if nbr == b:
-                return True
-            elif reachable_r(nbr,b,seenbonds):
-                return True
-    return False
-
-
 def reachable(a,b):
     '''Return true if atom b is reachable from a without using the bond between them.'''
     if a.GetExplicitDegree() == 1 or b.GetExplicitDegree() == 1:
         return False #this is the _only_ bond for one atom
-    #otherwise do recursive traversal
+    #otherwise do an iterative traversal with an explicit stack, which
+    #avoids recursion depth limits and per-call overhead; compare atom
+    #indices rather than swig proxies and stop as soon as b is found
     seenbonds = set([a.GetBond(b).GetIdx()])
-    return reachable_r(a,b,seenbonds)
+    b_idx = b.GetIdx()
+    stack = [a]
+    while stack:
+        cur = stack.pop()
+        for nbr in ob.OBAtomAtomIter(cur):
+            bond = cur.GetBond(nbr).GetIdx()
+            if bond not in seenbonds:
+                seenbonds.add(bond)
+                if nbr.GetIdx() == b_idx:
+                    return True
+                stack.append(nbr)
+    return False
 
 
 def forms_small_angle(a,b,cutoff=45):
@@ -356,44 +363,63 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
 
     Assumes no hydrogens or existing bonds.
     '''
-    pt = Chem.GetPeriodicTable()
-
     if len(atoms) == 0:
         return
 
     mol.BeginModify()
 
-    #just going to to do n^2 comparisons, can worry about efficiency later
-    coords = np.array([(a.GetX(),a.GetY(),a.GetZ()) for a in atoms])
-    dists = squareform(pdist(coords))
+    #keep the condensed distance vector and extract the qualifying
+    #pairs up front, so python only loops over actual candidate bonds
+    #float32 is plenty for fit coordinates and halves the bandwidth of
+    #the pairwise distance math below
+    coords = np.array([(a.GetX(),a.GetY(),a.GetZ()) for a in atoms], dtype=np.float32)
     types = [struct.channels[t].name for t in struct.c]
-
-    for (i,a) in enumerate(atoms):
-        for (j,b) in enumerate(atoms):
-            if a == b:
-                break
-            if dists[i,j] < 0.01:  #reduce from 0.4
-                continue #don't bond too close atoms
-            if dists[i,j] < maxbond:
-                flag = 0
-                if 'Aromatic' in types[i] and 'Aromatic' in types[j]:
-                    flag = ob.OB_AROMATIC_BOND
-                mol.AddBond(a.GetIdx(),b.GetIdx(),1,flag)
+    idxs = [a.GetIdx() for a in atoms]
+    is_aromatic = ['Aromatic' in t for t in types]
+
+    #a kd-tree query only returns pairs within the max bond length,
+    #so the work scales with the candidate count instead of n^2
+    pairs = cKDTree(coords).query_pairs(r=maxbond, output_type='ndarray')
+    d2 = ((coords[pairs[:,0]] - coords[pairs[:,1]])**2).sum(axis=1)
+    #unbox the surviving pairs to python ints in one tolist call
+    for i, j in pairs[d2 >= 0.01**2].tolist(): #reduce from 0.4
+        flag = 0
+        if is_aromatic[i] and is_aromatic[j]:
+            flag = ob.OB_AROMATIC_BOND
+        mol.AddBond(idxs[i],idxs[j],1,flag)
+
+    #read each atom's element once; the accessors are swig calls
+    atomic_nums = np.array([a.GetAtomicNum() for a in atoms])
+
+    #gather the per-element valence limits from the module tables
+    maxb_all = np.minimum(
+        _ob_max_bonds[atomic_nums], _rd_default_valence[atomic_nums]
+    )
+
+    #count oxygen neighbors for the sulfone check with one pass over
+    #the bonds instead of re-walking each sulfur's neighbor list
+    n_oxy_nbrs = dict.fromkeys(idxs, 0)
+    if (atomic_nums == 16).any():
+        num_by_idx = dict(zip(idxs, atomic_nums))
+        for bond in ob.OBMolBondIter(mol):
+            i1 = bond.GetBeginAtomIdx()
+            i2 = bond.GetEndAtomIdx()
+            if num_by_idx[i2] == 8:
+                n_oxy_nbrs[i1] += 1
+            if num_by_idx[i1] == 8:
+                n_oxy_nbrs[i2] += 1
 
     atom_maxb = {}
     for (i,a) in enumerate(atoms):
-        #set max valance to the smallest max allowed by openbabel or rdkit
-        #since we want the molecule to be valid for both (rdkit is usually lower)
-        maxb = ob.GetMaxBonds(a.GetAtomicNum())
-        maxb = min(maxb,pt.GetDefaultValence(a.GetAtomicNum())) 
+        maxb = int(maxb_all[i])
 
-        if a.GetAtomicNum() == 16: # sulfone check
-            if count_nbrs_of_elem(a, 8) >= 2:
+        if atomic_nums[i] == 16: # sulfone check
+            if n_oxy_nbrs[idxs[i]] >= 2:
                 maxb = 6
 
         if 'Donor' in types[i]:
             maxb -= 1 #leave room for hydrogen
-        atom_maxb[a.GetIdx()] = maxb
+        atom_maxb[idxs[i]] = maxb
 
     #remove any impossible bonds between halogens
     for bond in ob.OBMolBondIter(mol):
@@ -402,26 +428,34 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
         if atom_maxb[a1.GetIdx()] == 1 and atom_maxb[a2.GetIdx()] == 1:
             mol.DeleteBond(bond)
 
+    #look up each element's covalent radius once instead of per bond
+    covalent_rad = {z: ob.GetCovalentRad(z) for z in set(atomic_nums)}
+
     def get_bond_info(biter):
         '''Return bonds sorted by their distortion'''
         bonds = [b for b in biter]
-        binfo = []
-        for bond in bonds:
-            bdist = bond.GetLength()
-            #compute how far away from optimal we are
-            a1 = bond.GetBeginAtom()
-            a2 = bond.GetEndAtom()
-            ideal = ob.GetCovalentRad(a1.GetAtomicNum()) + ob.GetCovalentRad(a2.GetAtomicNum()) 
-            stretch = bdist-ideal
-            binfo.append((stretch,bdist,bond))
-        binfo.sort(reverse=True, key=lambda t: t[:2]) #most stretched bonds first
-        return binfo
+        if not bonds:
+            return []
+        #compute how far away from optimal we are as arrays, then sort
+        #with one vectorized lexsort instead of python tuple compares
+        bdists = np.array([b.GetLength() for b in bonds])
+        ideals = np.array([
+            covalent_rad[b.GetBeginAtom().GetAtomicNum()]
+            + covalent_rad[b.GetEndAtom().GetAtomicNum()]
+            for b in bonds
+        ])
+        stretches = bdists - ideals
+        order = np.lexsort((-bdists, -stretches)) #most stretched bonds first
+        return [(stretches[k], bdists[k], bonds[k]) for k in order]
 
     #prioritize removing hypervalency causing bonds, do more valent 
     #constrained atoms first since their bonds introduce the most problems
     #with reachability (e.g. oxygen)
-    hypers = sorted([(atom_maxb[a.GetIdx()],a.GetExplicitValence() - atom_maxb[a.GetIdx()], a) for a in atoms],key=lambda aa: (aa[0],-aa[1]))
-    for mb,diff,a in hypers:
+    ev = np.fromiter((a.GetExplicitValence() for a in atoms), np.int32)
+    mv = np.fromiter((atom_maxb[i] for i in idxs), np.int32)
+    #lexsort keys: max valence ascending, then excess valence descending
+    for k in np.lexsort((mv - ev, mv)).tolist():
+        a = atoms[k]
         if a.GetExplicitValence() <= atom_maxb[a.GetIdx()]:
             continue
         binfo = get_bond_info(ob.OBAtomBondIter(a))
@@ -441,6 +475,25 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
                     break #let nbr atoms choose what bonds to throw out
 
 
+    #atom positions never change during cleanup (only bonds are
+    #deleted), so test the small-angle condition against the cached
+    #coordinates with one vectorized cosine per atom instead of a
+    #GetAngle call per neighbor
+    pos = np.zeros((max(idxs)+1, 3), dtype=np.float32)
+    pos[idxs] = coords
+    cos_cutoff = np.cos(np.radians(45))
+
+    def forms_small_angle_np(a, b):
+        a_idx = a.GetIdx()
+        b_idx = b.GetIdx()
+        nbrs = [n.GetIdx() for n in ob.OBAtomAtomIter(a) if n.GetIdx() != b_idx]
+        if not nbrs:
+            return False
+        v1 = pos[b_idx] - pos[a_idx]
+        V = pos[nbrs] - pos[a_idx]
+        cos = (V @ v1) / (np.linalg.norm(V, axis=1)*np.linalg.norm(v1))
+        return bool((cos > cos_cutoff).any())
+
     binfo = get_bond_info(ob.OBMolBondIter(mol))
     #now eliminate geometrically poor bonds
     for stretch,bdist,bond in binfo:
@@ -452,7 +505,7 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
         #that are excessively far away (0.45 from ConnectTheDots)
         #get bonds to be less than max allowed
         #also remove tight angles, because that is what ConnectTheDots does
-        if stretch > 0.45 or forms_small_angle(a1,a2) or forms_small_angle(a2,a1):
+        if stretch > 0.45 or forms_small_angle_np(a1,a2) or forms_small_angle_np(a2,a1):
             #don't fragment the molecule
             if not reachable(a1,a2):
                 continue
@@ -461,13 +514,19 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
     mol.EndModify()
 
 
-def make_obmol(struct,verbose=False):
+def make_obmol(struct,verbose=False,track_visited=True):
     '''Create an OBMol from AtomStruct that attempts to maintain
-    correct atom typing'''
+    correct atom typing.  Snapshots of each stage are kept in
+    visited_mols unless track_visited is False, since each snapshot
+    is a full copy of the molecule.'''
     mol = ob.OBMol()
     mol.BeginModify()
     visited_mols = []
 
+    def snapshot():
+        if track_visited:
+            visited_mols.append(ob.OBMol(mol))
+
     atoms = []
     for xyz,t in zip(struct.xyz, struct.c):
         x,y,z = map(float,xyz)
@@ -478,30 +537,30 @@ def make_obmol(struct,verbose=False):
         atoms.append(atom)
 
     fixup(atoms, mol, struct)
-    visited_mols.append(ob.OBMol(mol))
+    snapshot()
 
     connect_the_dots(mol, atoms, struct)
     fixup(atoms, mol, struct)
-    visited_mols.append(ob.OBMol(mol))
+    snapshot()
 
     mol.EndModify()
 
     mol.AddPolarHydrogens() #make implicits explicit
-    visited_mols.append(ob.OBMol(mol))
+    snapshot()
 
     mol.PerceiveBondOrders()
     fixup(atoms, mol, struct)
-    visited_mols.append(ob.OBMol(mol))
+    snapshot()
 
     for (i,a) in enumerate(atoms):
         ob.OBAtomAssignTypicalImplicitHydrogens(a)
 
     fixup(atoms, mol, struct)
-    visited_mols.append(ob.OBMol(mol))
+    snapshot()
 
     mol.AddHydrogens()
     fixup(atoms, mol, struct)
-    visited_mols.append(ob.OBMol(mol))
+    snapshot()
 
     #make rings all aromatic if majority of carbons are aromatic
     for ring in ob.OBMolRingIter(mol):
@@ -520,14 +579,16 @@ def make_obmol(struct,verbose=False):
                     a = mol.GetAtom(ai)
                     a.SetAromatic(True)
 
-    #bonds must be marked aromatic for smiles to match
+    #bonds must be marked aromatic for smiles to match; read each
+    #atom's aromatic flag once instead of twice per bond
+    arom = np.zeros(mol.NumAtoms()+1, dtype=bool)
+    for a in ob.OBMolAtomIter(mol):
+        arom[a.GetIdx()] = a.IsAromatic()
     for bond in ob.OBMolBondIter(mol):
-        a1 = bond.GetBeginAtom()
-        a2 = bond.GetEndAtom()
-        if a1.IsAromatic() and a2.IsAromatic():
+        if arom[bond.GetBeginAtomIdx()] and arom[bond.GetEndAtomIdx()]:
             bond.SetAromatic(True)
 
-    visited_mols.append(ob.OBMol(mol))
+    snapshot()
 
     mismatches = 0
     for (a,t) in zip(atoms,struct.c):
@@ -602,25 +663,33 @@ def convert_ob_mol_to_rd_mol(ob_mol,struct=None):
 
     rd_mol = Chem.RemoveHs(rd_mol, sanitize=False)
 
-    pt = Chem.GetPeriodicTable()
     #if double/triple bonds are connected to hypervalent atoms, decrement the order
 
     positions = rd_mol.GetConformer().GetPositions()
-    nonsingles = []
+    idx_pairs = []
+    bond_objs = []
     for bond in rd_mol.GetBonds():
         if bond.GetBondType() == Chem.BondType.DOUBLE or bond.GetBondType() == Chem.BondType.TRIPLE:
-            i = bond.GetBeginAtomIdx()
-            j = bond.GetEndAtomIdx()
-            dist = np.linalg.norm(positions[i]-positions[j])
-            nonsingles.append((dist,bond))
-    nonsingles.sort(reverse=True, key=lambda t: t[0])
-
-    for (d,bond) in nonsingles:
+            idx_pairs.append((bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()))
+            bond_objs.append(bond)
+
+    #compute all the bond lengths at once and process longest first
+    if idx_pairs:
+        pair_arr = np.array(idx_pairs)
+        dists = np.linalg.norm(positions[pair_arr[:,0]] - positions[pair_arr[:,1]], axis=1)
+        order = np.argsort(-dists)
+    else:
+        order = []
+
+    for k in order:
+        bond = bond_objs[k]
         a1 = bond.GetBeginAtom()
         a2 = bond.GetEndAtom()
 
-        if calc_valence(a1) > pt.GetDefaultValence(a1.GetAtomicNum()) or \
-           calc_valence(a2) > pt.GetDefaultValence(a2.GetAtomicNum()):
+        #read the default valences from the module table instead of
+        #calling into the periodic table per bond endpoint
+        if calc_valence(a1) > _rd_default_valence[a1.GetAtomicNum()] or \
+           calc_valence(a2) > _rd_default_valence[a2.GetAtomicNum()]:
             btype = Chem.BondType.SINGLE
             if bond.GetBondType() == Chem.BondType.TRIPLE:
                 btype = Chem.BondType.DOUBLE
@@ -634,13 +703,11 @@ def convert_ob_mol_to_rd_mol(ob_mol,struct=None):
     rd_mol = Chem.AddHs(rd_mol,addCoords=True)
 
     positions = rd_mol.GetConformer().GetPositions()
-    center = np.mean(positions[np.all(np.isfinite(positions),axis=1)],axis=0)
-    for atom in rd_mol.GetAtoms():
-        i = atom.GetIdx()
-        pos = positions[i]
-        if not np.all(np.isfinite(pos)):
-            #hydrogens on C fragment get set to nan (shouldn't, but they do)
-            rd_mol.GetConformer().SetAtomPosition(i,center)
+    finite = np.isfinite(positions).all(axis=1)
+    center = positions[finite].mean(axis=0) if finite.any() else np.zeros(3)
+    for i in np.where(~finite)[0].tolist():
+        #hydrogens on C fragment get set to nan (shouldn't, but they do)
+        rd_mol.GetConformer().SetAtomPosition(i,center)
 
     try:
         Chem.SanitizeMol(rd_mol,Chem.SANITIZE_ALL^Chem.SANITIZE_KEKULIZE)
@@ -669,9 +736,9 @@ def convert_ob_mol_to_rd_mol(ob_mol,struct=None):
     return rd_mol
 
 
-def make_rdmol(struct,verbose=False):
+def make_rdmol(struct,verbose=False,track_visited=True):
     '''Create RDKIT mol from AtomStruct trying to respect types.'''
-    mol,misses,visited_mols = make_obmol(struct,verbose)
+    mol,misses,visited_mols = make_obmol(struct,verbose,track_visited)
     return convert_ob_mol_to_rd_mol(mol.OBMol), misses, [
         convert_ob_mol_to_rd_mol(mol) for mol in visited_mols
     ]
@@ -1,10 +1,10 @@
 from __future__ import print_function
-import sys, os, re, argparse, time, glob, struct, gzip, pickle
+import sys, os, re, argparse, time, glob, struct, gzip, pickle, heapq, io
 import datetime as dt
 import numpy as np
 import pandas as pd
 import scipy as sp
-from collections import defaultdict, Counter
+from collections import defaultdict, deque, Counter
 import threading
 import contextlib
 import tempfile
@@ -13,12 +13,14 @@ try:
     from itertools import izip
 except ImportError:
     izip = zip
-from functools import partial
+from functools import partial, lru_cache
 from scipy.stats import multivariate_normal
+from scipy.spatial import cKDTree
 
 import torch
 import torch.multiprocessing as mp
 import torch.nn.functional as F
+torch.backends.cudnn.benchmark = True # grid shapes are fixed per run
 from GPUtil import getGPUs
 from openbabel import openbabel as ob
 from openbabel import pybel
@@ -41,32 +43,31 @@ import fitting as dkoes_fitting
 
 def remove_tensors(obj, visited=None):
     '''
-    Recursively traverse an object converting pytorch tensors
-    to numpy arrays in-place.
+    Traverse an object converting pytorch tensors to numpy
+    arrays in-place, iteratively so that thousands of visited
+    structs don't approach the recursion limit.
     '''
     visited = visited or set()
+    queue = deque([obj])
 
-    if not isinstance(obj, (AtomGrid, AtomStruct, list, dict)) or id(obj) in visited:
-        #avoid traversing everything
-        return obj
+    while queue:
+        o = queue.popleft()
 
-    visited.add(id(obj))
+        if not isinstance(o, (AtomGrid, AtomStruct, list, dict)) or id(o) in visited:
+            #avoid traversing everything
+            continue
 
-    dct = None
-    if isinstance(obj, dict):
-        dct = obj
-    elif hasattr(obj, '__dict__'):
-        dct = obj.__dict__
+        visited.add(id(o))
 
-    if dct:
-        for k, v in dct.items():
-            if isinstance(v, torch.Tensor):
-                dct[k] = v.cpu().detach().numpy()
-            else:
-                dct[k] = remove_tensors(v, visited)
-    elif isinstance(obj, list):
-        for i, v in enumerate(obj):
-            obj[i] = remove_tensors(obj[i], visited)
+        if isinstance(o, list):
+            queue.extend(o)
+        else:
+            dct = o if isinstance(o, dict) else o.__dict__
+            for k, v in dct.items():
+                if isinstance(v, torch.Tensor):
+                    dct[k] = v.cpu().detach().numpy()
+                else:
+                    queue.append(v)
 
     return obj
 
@@ -112,6 +113,7 @@ class AtomFitter(object):
         output_kernel,
         device,
         verbose=0,
+        output_visited=True,
     ):
         # number of best structures to store and expand during search
         self.beam_size = beam_size
@@ -148,9 +150,29 @@ class AtomFitter(object):
         self.device = device
         self.verbose = verbose
 
+        # snapshotting every intermediate molecule is only useful
+        # when the visited structures are actually written out
+        self.output_visited = output_visited
+
         self.grid_maker = molgrid.GridMaker()
         self.c2grid = molgrid.Coords2Grid(self.grid_maker)
         self.kernel = None
+        self.radii_cache = dict()
+        self.c2grid_key = None
+        self.origin_key = None
+
+    def get_radii(self, channels):
+        '''
+        Return a tensor of the atomic radii of channels,
+        cached so that hot loops don't rebuild it per call.
+        '''
+        key = id(channels)
+        if key not in self.radii_cache:
+            self.radii_cache[key] = torch.tensor(
+                [ch.atomic_radius for ch in channels],
+                device=self.device,
+            )
+        return self.radii_cache[key]
 
     def init_kernel(self, channels, resolution, deconv=False):
         '''
@@ -163,10 +185,7 @@ class AtomFitter(object):
         # struct with one atom of each type at the center
         xyz = torch.zeros((n_channels, 3), device=self.device)
         c = torch.eye(n_channels, device=self.device) # one-hot vector types
-        r = torch.tensor(
-            [ch.atomic_radius for ch in channels], 
-            device=self.device
-        )
+        r = self.get_radii(channels)
         self.grid_maker.set_radii_type_indexed(True)
         self.grid_maker.set_resolution(resolution)
 
@@ -181,6 +200,7 @@ class AtomFitter(object):
             )
 
         self.c2grid.center = (0.,0.,0.)
+        self.c2grid_key = None # gridder now configured for the kernel
         values = self.c2grid(xyz, c, r)
 
         if deconv:
@@ -197,6 +217,16 @@ class AtomFitter(object):
             resolution=resolution,
         )
 
+        # pre-shape the kernel as conv3d weights in channels-last
+        # memory format so cuDNN skips layout conversions per call
+        self.kernel_weight = values.unsqueeze(1).contiguous(
+            memory_format=torch.channels_last_3d
+        )
+
+        # the kernel is fixed after init, so cache the norm used to
+        # normalize convolved grids instead of recomputing per call
+        self.kernel_norm2 = (values**2).sum(dim=(1,2,3), keepdim=True)
+
         if self.output_kernel:
             dx_prefix = 'deconv_kernel' if deconv else 'conv_kernel'
             if self.verbose:
@@ -219,15 +249,24 @@ class AtomFitter(object):
         if self.kernel is None:
             self.init_kernel(channels, resolution)
 
-        # normalize convolved grid channels by kernel norm
-        kernel_norm2 = (self.kernel.values**2).sum(dim=(1,2,3), keepdim=True)
+        # density values are small, so the convolution is well within
+        # bfloat16 range; autocast halves its memory traffic on gpu
+        with torch.autocast(
+            device_type='cuda', dtype=torch.bfloat16,
+            enabled=(self.device == 'cuda'),
+        ):
+            conv = F.conv3d(
+                input=grid.unsqueeze(0).contiguous(
+                    memory_format=torch.channels_last_3d
+                ),
+                weight=self.kernel_weight,
+                padding=self.kernel_weight.shape[-1]//2,
+                groups=len(channels),
+            )
 
-        return F.conv3d(
-            input=grid.unsqueeze(0),
-            weight=self.kernel.values.unsqueeze(1),
-            padding=self.kernel.values.shape[-1]//2,
-            groups=len(channels),
-        )[0] / kernel_norm2
+        # dividing by the float32 norm promotes back to float32
+        # for the threshold and ranking comparisons downstream
+        return conv[0] / self.kernel_norm2
 
     def detect_atoms(self, grid, channels, center, resolution, types=None):
         '''
@@ -245,9 +284,6 @@ class AtomFitter(object):
         apply_threshold = self.threshold is not None and self.threshold > -np.inf
         suppress_non_max = self.min_dist is not None and self.min_dist > 0.0
 
-        if apply_peak_value:
-            peak_value = torch.full((n_channels,), self.peak_value, device=self.device)
-
         if apply_threshold:
             threshold = torch.full((n_channels,), self.threshold, device=self.device)
 
@@ -257,11 +293,26 @@ class AtomFitter(object):
 
         # reflect grid values above peak value
         if apply_peak_value:
-            peak_value = peak_value.view(n_channels, 1, 1, 1)
-            grid = peak_value - (peak_value - grid).abs()
+            grid = torch.where(
+                grid > self.peak_value, 2*self.peak_value - grid, grid
+            )
+
+        n_voxels = grid.numel()
 
-        # sort grid points by value
-        values, idx = torch.sort(grid.flatten(), descending=True)
+        if self.n_atoms_detect >= 0 and apply_threshold:
+            # only a few grid points can become atoms and the threshold
+            # discards the rest, so find the top-k values instead of
+            # sorting the whole grid, expanding k until the tail of the
+            # top-k falls below the threshold (i.e. every grid point
+            # that could pass the threshold filter has been found)
+            k = min(max(32*self.n_atoms_detect, 1024), n_voxels)
+            values, idx = torch.topk(grid.flatten(), k)
+            while k < n_voxels and values[-1] > self.threshold:
+                k = min(2*k, n_voxels)
+                values, idx = torch.topk(grid.flatten(), k)
+
+        else: # sort grid points by value
+            values, idx = torch.sort(grid.flatten(), descending=True)
 
         # convert flattened grid index to channel and spatial index
         idx_z, idx = idx % grid_dim, idx // grid_dim
@@ -291,57 +342,83 @@ class AtomFitter(object):
             # Need to exclude all atoms of type t beyond rank n_t
             # where n_t is the number of atoms left of type t
 
-        # convert spatial index to atom coordinates
-        origin = center - resolution * (float(grid_dim) - 1) / 2.0
-        xyz = origin + resolution * idx_xyz.float()
+        # convert spatial index to atom coordinates; the grid frame
+        # is fixed across the beam search, so cache the origin
+        # instead of recomputing it on every detection (key on the
+        # center values- object ids get reused across fits)
+        origin_key = (tuple(center.tolist()), grid_dim, resolution)
+        if origin_key != self.origin_key:
+            self.origin = center - resolution * (float(grid_dim) - 1) / 2.0
+            self.origin_key = origin_key
+        xyz = self.origin + resolution * idx_xyz.float()
 
         # suppress atoms too close to a higher-value atom of same type
         if suppress_non_max and self.n_atoms_detect > 1:
 
-            r = torch.tensor(
-                [ch.atomic_radius for ch in channels],
-                device=self.device,
-            )
-            if len(idx_c) < 1000: # use NxN matrices
-                same_type = (idx_c.unsqueeze(1) == idx_c.unsqueeze(0))
-                bond_radius = r[idx_c].unsqueeze(1) + r[idx_c].unsqueeze(0)
-                min_dist2 = (self.min_dist * bond_radius)**2
-                dist2 = ((xyz.unsqueeze(1) - xyz.unsqueeze(0))**2).sum(dim=2)
-                # the lower triangular part of a matrix under diagonal -1
-                #   gives those indices i,j such that i > j
-                # since atoms are sorted by decreasing density value,
-                #   i > j implies that atom i has lower value than atom j
-                # we use this to check a condition on each atom
-                #   only with respect to atoms of higher value 
-                too_close = torch.tril(
-                    (dist2 < min_dist2) & same_type, diagonal=-1
-                ).any(dim=1)
-                xyz = xyz[~too_close]
-                idx_c = idx_c[~too_close]
-
-            else: # use a for loop
-                xyz_max = xyz[0].unsqueeze(0)
-                idx_c_max = idx_c[0].unsqueeze(0)
-
-                for i in range(1, len(idx_c)):
-                    same_type = (idx_c[i] == idx_c_max)
-                    bond_radius = r[idx_c[i]] + r[idx_c_max]
+            r = self.get_radii(channels)
+            if len(idx_c) < 10000: # use per-type matrices
+                # only atoms of the same type can suppress each other,
+                # so compare each atom just to others of its own type
+                # instead of building NxN matrices over all atoms
+                keep = torch.ones(len(idx_c), dtype=torch.bool, device=self.device)
+                for c in idx_c.unique():
+                    is_c = (idx_c == c)
+                    xyz_c = xyz[is_c]
+                    min_dist2 = (self.min_dist * 2 * r[c])**2
+                    dist2 = ((xyz_c.unsqueeze(1) - xyz_c.unsqueeze(0))**2).sum(dim=2)
+                    # the lower triangular part of a matrix under diagonal -1
+                    #   gives those indices i,j such that i > j
+                    # since atoms are sorted by decreasing density value,
+                    #   i > j implies that atom i has lower value than atom j
+                    # we use this to check a condition on each atom
+                    #   only with respect to atoms of higher value
+                    too_close = torch.tril(
+                        dist2 < min_dist2, diagonal=-1
+                    ).any(dim=1)
+                    keep[is_c] = ~too_close
+                xyz = xyz[keep]
+                idx_c = idx_c[keep]
+
+            else: # use a sequential scan on the CPU
+                # compare each atom against the atoms kept so far using
+                # preallocated numpy buffers, instead of per-iteration
+                # torch.cat calls that reallocate the kept tensors
+                xyz_np = xyz.cpu().numpy()
+                idx_c_np = idx_c.cpu().numpy()
+                r_np = r.cpu().numpy()
+                n = len(idx_c_np)
+                keep = np.zeros(n, dtype=bool)
+                kept_xyz = np.empty((n, 3), dtype=xyz_np.dtype)
+                kept_c = np.empty(n, dtype=idx_c_np.dtype)
+                n_kept = 0
+
+                for i in range(n):
+                    same_type = (idx_c_np[i] == kept_c[:n_kept])
+                    bond_radius = r_np[idx_c_np[i]] + r_np[kept_c[:n_kept]]
                     min_dist2 = (self.min_dist * bond_radius)**2
-                    dist2 = ((xyz[i].unsqueeze(0) - xyz_max)**2).sum(dim=1)
+                    dist2 = ((xyz_np[i] - kept_xyz[:n_kept])**2).sum(axis=1)
                     if not ((dist2 < min_dist2) & same_type).any():
-                        xyz_max = torch.cat([xyz_max, xyz[i].unsqueeze(0)])
-                        idx_c_max = torch.cat([idx_c_max, idx_c[i].unsqueeze(0)])
+                        kept_xyz[n_kept] = xyz_np[i]
+                        kept_c[n_kept] = idx_c_np[i]
+                        keep[i] = True
+                        n_kept += 1
 
-                xyz = xyz_max
-                idx_c = idx_c_max
+                keep = torch.from_numpy(keep).to(self.device)
+                xyz = xyz[keep]
+                idx_c = idx_c[keep]
 
         # limit total number of detected atoms
         if self.n_atoms_detect >= 0:
             xyz = xyz[:self.n_atoms_detect]
             idx_c = idx_c[:self.n_atoms_detect]
 
-        # convert atom type channel index to one-hot type vector
-        c = F.one_hot(idx_c, n_channels).to(dtype=torch.float32, device=self.device)
+        # convert atom type channel index to one-hot type vector,
+        # writing float32 directly instead of casting the int64
+        # output of F.one_hot
+        c = torch.zeros(
+            (len(idx_c), n_channels), dtype=torch.float32, device=self.device
+        )
+        c.scatter_(1, idx_c.unsqueeze(1), 1.0)
 
         return xyz.detach(), c.detach()
 
@@ -364,9 +441,15 @@ class AtomFitter(object):
         '''
         t_start = time.time()
 
-        # get true grid on appropriate device
+        # get true grid on appropriate device; stage host grids in
+        # pinned memory so the upload is an async copy that overlaps
+        # with the type count setup below
+        values = torch.as_tensor(grid.values)
+        if self.device == 'cuda' and not values.is_cuda:
+            values = values.contiguous().pin_memory()
+
         grid_true = AtomGrid(
-            values=torch.as_tensor(grid.values, device=self.device),
+            values=values.to(self.device, non_blocking=True),
             channels=grid.channels,
             center=torch.as_tensor(grid.center, device=self.device),
             resolution=grid.resolution,
@@ -374,8 +457,6 @@ class AtomFitter(object):
 
         # get true atom type counts on appropriate device
         types = torch.tensor(types, dtype=torch.float32, device=self.device)
-        print("grid max",grid.values.max())
-        print("grid min",grid.values.min())
         if self.estimate_types: # estimate atom type counts from grid density
             types_est = self.get_types_estimate(
                 grid_true.values,
@@ -394,9 +475,9 @@ class AtomFitter(object):
         c = torch.zeros((0, n_channels), dtype=torch.float32, device=self.device)
 
         if self.fit_L1_loss:
-            fit_loss = grid_true.values.abs().sum()
+            fit_loss = torch.linalg.vector_norm(grid_true.values, ord=1)
         else:
-            fit_loss = (grid_true.values**2).sum() / 2.0
+            fit_loss = torch.linalg.vector_norm(grid_true.values)**2 / 2.0
         type_loss = types.abs().sum()
 
         # to constrain types, order structs first by type diff, then by L2 loss
@@ -489,27 +570,44 @@ class AtomFitter(object):
                         (objective_new, struct_id, time.time()-t_start, xyz_new, c_new)
                     )
 
-                if do_single_atom:
+                if do_single_atom and len(c_next) > 0:
 
-                    # evaluate each possible next atom individually
-                    for xyz_next_, c_next_ in zip(xyz_next, c_next):
-
-                        # add next atom to structure
-                        xyz_new = torch.cat([xyz, xyz_next_.unsqueeze(0)])
-                        c_new = torch.cat([c, c_next_.unsqueeze(0)])
+                    # preallocate a batch of structures, each with one
+                    # of the candidate next atoms appended
+                    n_atoms = xyz.shape[0]
+                    n_next = len(c_next)
+                    xyz_batch = torch.empty(
+                        (n_next, n_atoms+1, 3), dtype=xyz.dtype, device=self.device
+                    )
+                    c_batch = torch.empty(
+                        (n_next, n_atoms+1, n_channels), dtype=c.dtype, device=self.device
+                    )
+                    xyz_batch[:,:n_atoms] = xyz
+                    c_batch[:,:n_atoms] = c
+                    xyz_batch[:,n_atoms] = xyz_next
+                    c_batch[:,n_atoms] = c_next
+
+                    # evaluate all single-atom additions with one batched
+                    # gradient descent instead of one call per atom
+                    xyz_batch, grid_pred, grid_diff, fit_loss = self.fit_gd(
+                        grid_true, xyz_batch, c_batch, self.interm_gd_iters
+                    )
 
-                        # compute diff and loss after gradient descent
-                        xyz_new, grid_pred, grid_diff, fit_loss = self.fit_gd(
-                            grid_true, xyz_new, c_new, self.interm_gd_iters
-                        )
+                    # compute all candidate objectives with a single
+                    # device sync instead of one .item() per candidate
+                    type_diff_batch = types.unsqueeze(0) - c_batch.sum(dim=1)
+                    type_losses = type_diff_batch.abs().sum(dim=1).tolist()
+                    fit_losses = fit_loss.tolist()
 
-                        type_diff = types - c_new.sum(dim=0)
-                        type_loss = type_diff.abs().sum()
+                    for k in range(n_next):
+                        xyz_new = xyz_batch[k]
+                        c_new = c_batch[k]
+                        type_diff = type_diff_batch[k]
 
                         if self.constrain_types:
-                            objective_new = (type_loss.item(), fit_loss.item())
+                            objective_new = (type_losses[k], fit_losses[k])
                         else:
-                            objective_new = fit_loss.item()
+                            objective_new = fit_losses[k]
 
                         # check if new structure is one of the best yet
                         if any(objective_new < s[0] for s in best_structs):
@@ -517,7 +615,7 @@ class AtomFitter(object):
                             print('Found new best struct {}'.format(struct_count))
 
                             xyz_new_next, c_new_next = self.detect_atoms(
-                                grid_diff,
+                                grid_diff[k],
                                 grid_true.channels,
                                 grid_true.center,
                                 grid_true.resolution,
@@ -544,7 +642,10 @@ class AtomFitter(object):
 
             if found_new_best_struct: # determine new set of best structures
 
-                best_structs = sorted(best_structs + new_best_structs)[:self.beam_size]
+                # select the beam_size best structs without sorting the rest
+                best_structs = heapq.nsmallest(
+                    self.beam_size, best_structs + new_best_structs
+                )
                 best_objective = best_structs[0][0]
                 best_id = best_structs[0][1]
                 best_n_atoms = best_structs[0][2].shape[0]
@@ -573,8 +674,8 @@ class AtomFitter(object):
         )
 
         # compute the final L2 and L1 loss
-        L2_loss = (grid_diff**2).sum() / 2
-        L1_loss = grid_diff.abs().sum()
+        L2_loss = torch.linalg.vector_norm(grid_diff)**2 / 2
+        L1_loss = torch.linalg.vector_norm(grid_diff, ord=1)
 
         if self.constrain_types:
             best_objective = (type_loss.item(), fit_loss.item())
@@ -630,38 +731,71 @@ class AtomFitter(object):
         return remove_tensors(grid_pred)
 
     def fit_gd(self, grid, xyz, c, n_iters):
+        '''
+        Fit the structure (xyz, c) to the grid by gradient descent
+        on the atom coordinates. A leading batch dimension on xyz
+        and c fits a batch of structures in one descent, with a
+        single optimizer and backward pass per iteration.
+        '''
+        batched = (xyz.dim() == 3)
+        if not batched:
+            xyz, c = xyz.unsqueeze(0), c.unsqueeze(0)
 
-        r = torch.tensor(
-            [ch.atomic_radius for ch in grid.channels],
-            device=self.device,
-        )
+        r = self.get_radii(grid.channels)
         xyz = xyz.clone().detach().to(self.device)
         c = c.clone().detach().to(self.device)
         xyz.requires_grad = True
 
         solver = torch.optim.Adam((xyz,), **self.gd_kwargs)
 
-        self.grid_maker.set_radii_type_indexed(True)
-        self.grid_maker.set_dimension(grid.dimension)
-        self.grid_maker.set_resolution(grid.resolution)
-        self.c2grid.center = tuple(grid.center.cpu().numpy().astype(float))
+        # the gridder settings only depend on the grid frame, which is
+        # fixed across the beam search, so skip the C++ setter calls
+        # when already configured for it (key on the center values-
+        # object ids get reused across fits)
+        center = tuple(grid.center.cpu().numpy().astype(float))
+        c2grid_key = (center, grid.dimension, grid.resolution)
+        if c2grid_key != self.c2grid_key:
+            self.grid_maker.set_radii_type_indexed(True)
+            self.grid_maker.set_dimension(grid.dimension)
+            self.grid_maker.set_resolution(grid.resolution)
+            self.c2grid.center = center
+            self.c2grid_key = c2grid_key
 
         for i in range(n_iters + 1):
-            solver.zero_grad()
-
-            grid_pred = self.c2grid(xyz, c, r)
+            # dropping the grad tensor is cheaper than zeroing it
+            solver.zero_grad(set_to_none=True)
+
+            # Coords2Grid is not batched, so splat each structure
+            # and stack the predicted grids
+            grid_pred = torch.stack([
+                self.c2grid(xyz_, c_, r) for xyz_, c_ in zip(xyz, c)
+            ])
             grid_diff = grid.values - grid_pred
+            # vector_norm reduces in one fused kernel, with no
+            # grid-sized abs/square intermediate
             if self.fit_L1_loss:
-                loss = grid_diff.abs().sum()
+                loss = torch.linalg.vector_norm(
+                    grid_diff.flatten(1), ord=1, dim=1
+                )
             else:
-                loss = (grid_diff**2).sum() / 2.0
+                loss = torch.linalg.vector_norm(
+                    grid_diff.flatten(1), dim=1
+                )**2 / 2.0
 
             if i == n_iters: # or converged
                 break
 
-            loss.backward()
+            # structures in the batch don't interact, so summing
+            # their losses gives each one the same gradients as a
+            # separate backward pass
+            loss.sum().backward()
             solver.step()
 
+        if not batched:
+            xyz, grid_pred, grid_diff, loss = (
+                xyz[0], grid_pred[0], grid_diff[0], loss[0]
+            )
+
         return (
             xyz.detach(),
             grid_pred.detach(),
@@ -677,12 +811,12 @@ class AtomFitter(object):
         '''
         # initial struct from atom fitting (no bonds)
         rd_mol = struct.to_rd_mol()
-        visited_mols = [rd_mol]
+        visited_mols = [rd_mol] if self.output_visited else []
 
         if self.dkoes_make_mol:
 
             rd_mol, misses, dkoes_visited_mols = dkoes_fitting.make_rdmol(
-                struct, self.verbose
+                struct, self.verbose, self.output_visited
             )
             visited_mols += dkoes_visited_mols
 
@@ -690,24 +824,28 @@ class AtomFitter(object):
             # connect the dots using openbabel
             ob_mol = struct.to_ob_mol()
             ob_mol.ConnectTheDots()
-            visited_mols.append(molecules.ob_mol_to_rd_mol(ob_mol))
+            if self.output_visited:
+                visited_mols.append(molecules.ob_mol_to_rd_mol(ob_mol))
 
             # perceive bonds in openbabel
             ob_mol.PerceiveBondOrders()
             rd_mol = molecules.ob_mol_to_rd_mol(ob_mol)
-            visited_mols.append(rd_mol)
+            if self.output_visited:
+                visited_mols.append(rd_mol)
 
             if not self.use_openbabel:
 
                 # connect fragments by adding min distance bonds
                 rd_mol = Chem.RWMol(rd_mol)
                 connect_rd_mol_frags(rd_mol)
-                visited_mols.append(rd_mol)
+                if self.output_visited:
+                    visited_mols.append(rd_mol)
 
                 # make aromatic rings using channel info
                 rd_mol = Chem.RWMol(rd_mol)
                 set_rd_mol_aromatic(rd_mol, struct.c, struct.channels)
-                visited_mols.append(rd_mol)
+                if self.output_visited:
+                    visited_mols.append(rd_mol)
 
         # be careful, this info is lost when the mol is copied
         rd_mol.info = {'visited_mols': visited_mols}
@@ -735,22 +873,19 @@ class AtomFitter(object):
 
 class DkoesAtomFitter(AtomFitter):
 
-    def __init__(self, dkoes_make_mol, use_openbabel, iters=25, tol=0.01):
+    def __init__(self, dkoes_make_mol, use_openbabel, iters=25, tol=0.01,
+                 output_visited=True):
         self.iters = iters
         self.tol = tol
         self.verbose=False
         self.dkoes_make_mol = dkoes_make_mol
         self.use_openbabel = use_openbabel
+        self.output_visited = output_visited
 
     def fit(self, grid, types):
 
-        grid = AtomGrid(
-            values=grid.values,
-            channels=grid.channels,
-            center=grid.center,
-            resolution=grid.resolution,
-        )
-
+        # simple_atom_fit only reads the grid, so pass it through
+        # instead of rebuilding an identical AtomGrid
         struct, grid_pred = \
             dkoes_fitting.simple_atom_fit(
                 mgrid=grid,
@@ -775,6 +910,20 @@ class DkoesAtomFitter(AtomFitter):
         return remove_tensors(grid_pred)
 
 
+def open_gzip_text(fname):
+    '''
+    Open a gzip file for text writing, with fast compression
+    and a large write buffer so that the many small sdf blocks
+    written per file don't each hit the compressor.
+    '''
+    return io.TextIOWrapper(
+        io.BufferedWriter(
+            gzip.open(fname, 'wb', compresslevel=3),
+            buffer_size=1<<20,
+        )
+    )
+
+
 class OutputWriter(object):
     '''
     A data structure for receiving and organizing AtomGrids and
@@ -822,11 +971,15 @@ class OutputWriter(object):
         self.dx_prefixes = []
         self.sdf_files = []
         self.centers = []
+        self.n_pymol_written = (0, 0)
 
         self.verbose = verbose
-        
+
         self.out_files = dict() # one file for all samples of given mol/grid
 
+        # reusable scratch buffer for grid-sized temporaries
+        self.grid_scratch = None
+
     def write(self, lig_name, grid_type, sample_idx, grid):
         '''
         Write output files for grid and compute metrics in
@@ -917,14 +1070,14 @@ class OutputWriter(object):
 
                 self.out_files[grid_prefix] = {}
 
-                # open output files for generated samples                
-                self.out_files[grid_prefix][start_fname] = gzip.open(start_fname, 'wt')
-                self.out_files[grid_prefix][add_fname] = gzip.open(add_fname, 'wt')                                
-                self.out_files[grid_prefix][min_fname] = gzip.open(min_fname, 'wt')
+                # open output files for generated samples
+                self.out_files[grid_prefix][start_fname] = open_gzip_text(start_fname)
+                self.out_files[grid_prefix][add_fname] = open_gzip_text(add_fname)
+                self.out_files[grid_prefix][min_fname] = open_gzip_text(min_fname)
 
                 # only output src file once
-                if is_real_grid: # write real input molecule                  
-                    src_file = gzip.open(src_fname, 'wt')
+                if is_real_grid: # write real input molecule
+                    src_file = open_gzip_text(src_fname)
                     src_mol = struct.info['src_mol']
                     write_sdfs(src_fname, src_file, src_mol)
 
@@ -936,7 +1089,13 @@ class OutputWriter(object):
             write_sdfs(add_fname, self.out_files[grid_prefix][add_fname], add_mol)                            
 
             if add_mol.info['min_mol']: # write minimized molecule
-                write_sdfs(min_fname, self.out_files[grid_prefix][min_fname], add_mol.info['min_mol'])                   
+                write_sdfs(min_fname, self.out_files[grid_prefix][min_fname], add_mol.info['min_mol'])
+
+            if sample_idx+1 == self.n_samples:
+                # every stream for this prefix is closed once the last
+                # sample is written, so drop the handles rather than
+                # accumulating one entry per prefix for the whole run
+                del self.out_files[grid_prefix]                   
 
         # write latent vector
         if is_gen_grid and self.output_latent:
@@ -978,13 +1137,7 @@ class OutputWriter(object):
                 if self.verbose:
                     print('Writing ' + self.pymol_file)
 
-                write_pymol_script(
-                    self.pymol_file,
-                    self.out_prefix,
-                    self.dx_prefixes,
-                    self.sdf_files,
-                    self.centers,
-                )
+                self.update_pymol_script()
                 del self.grids[lig_name]
 
         else: # only store until grids for this sample are ready
@@ -1009,15 +1162,25 @@ class OutputWriter(object):
                 if self.verbose:
                     print('Writing ' + self.pymol_file)
 
-                write_pymol_script(
-                    self.pymol_file,
-                    self.out_prefix,
-                    self.dx_prefixes,
-                    self.sdf_files,
-                    self.centers,
-                )
+                self.update_pymol_script()
                 del self.grids[lig_name][sample_idx]
 
+    def update_pymol_script(self):
+        '''
+        Append any entries added since the last call to the pymol
+        script, instead of rewriting every entry after each sample.
+        '''
+        n_dx, n_sdf = self.n_pymol_written
+        write_pymol_script(
+            self.pymol_file,
+            self.out_prefix,
+            self.dx_prefixes[n_dx:],
+            self.sdf_files[n_sdf:],
+            self.centers[n_sdf:],
+            mode='w' if (n_dx, n_sdf) == (0, 0) else 'a',
+        )
+        self.n_pymol_written = (len(self.dx_prefixes), len(self.sdf_files))
+
     def compute_metrics(self, lig_name, sample_idxs):
         '''
         Compute metrics for density grids, fit atom types, and
@@ -1027,17 +1190,29 @@ class OutputWriter(object):
 
         if self.batch_metrics:
 
-            lig_grid_mean = sum(
-                lig_grids[i]['lig'].values for i in sample_idxs
-            ) / self.n_samples
+            def batch_mean(values):
+                '''
+                Mean by in-place accumulation, instead of a chain
+                of pairwise sums that each allocate a full copy.
+                '''
+                accum = None
+                for v in values:
+                    if accum is None:
+                        accum = v * 1.0 # copy works on arrays and tensors
+                    else:
+                        accum += v
+                accum /= self.n_samples
+                return accum
 
-            lig_gen_grid_mean = sum(
+            lig_grid_mean = batch_mean(
+                lig_grids[i]['lig'].values for i in sample_idxs
+            )
+            lig_gen_grid_mean = batch_mean(
                 lig_grids[i]['lig_gen'].values for i in sample_idxs
-            ) / self.n_samples
-
-            lig_latent_mean = sum(
+            )
+            lig_latent_mean = batch_mean(
                 lig_grids[i]['lig_gen'].info['latent_vec'] for i in sample_idxs
-            ) / self.n_samples
+            )
 
         else:
             lig_grid_mean = None
@@ -1047,99 +1222,130 @@ class OutputWriter(object):
         for sample_idx in sample_idxs:
             idx = (lig_name, sample_idx)
 
+            # buffer the sample's metrics in a plain dict and write
+            # them to the data frame in one batched assignment, since
+            # every scalar .loc set pays the full pandas indexer cost
+            row = dict()
+
             lig_grid = lig_grids[sample_idx]['lig']
             lig_gen_grid = lig_grids[sample_idx]['lig_gen']
 
-            self.compute_grid_metrics(idx, 'lig', lig_grid, mean_grid=lig_grid_mean)
-            self.compute_grid_metrics(idx, 'lig_gen', lig_gen_grid, lig_grid, lig_gen_grid_mean)
+            self.compute_grid_metrics(row, 'lig', lig_grid, mean_grid=lig_grid_mean)
+            self.compute_grid_metrics(row, 'lig_gen', lig_gen_grid, lig_grid, lig_gen_grid_mean)
 
             lig_latent = lig_gen_grid.info['latent_vec']
-            self.compute_latent_metrics(idx, 'lig', lig_latent, lig_latent_mean)
+            self.compute_latent_metrics(row, 'lig', lig_latent, lig_latent_mean)
 
             if self.fit_atoms:
 
                 lig_fit_grid = lig_grids[sample_idx]['lig_fit']
                 lig_gen_fit_grid = lig_grids[sample_idx]['lig_gen_fit']
 
-                self.compute_grid_metrics(idx, 'lig_fit', lig_fit_grid, lig_grid)
-                self.compute_grid_metrics(idx, 'lig_gen_fit', lig_gen_fit_grid, lig_gen_grid)
+                self.compute_grid_metrics(row, 'lig_fit', lig_fit_grid, lig_grid)
+                self.compute_grid_metrics(row, 'lig_gen_fit', lig_gen_fit_grid, lig_gen_grid)
 
                 lig_struct = lig_grid.info['src_struct']
                 lig_fit_struct = lig_fit_grid.info['src_struct']
                 lig_gen_fit_struct = lig_gen_fit_grid.info['src_struct']
 
-                self.compute_struct_metrics(idx, 'lig', lig_struct)
-                self.compute_struct_metrics(idx, 'lig_fit', lig_fit_struct, lig_struct)
-                self.compute_struct_metrics(idx, 'lig_gen_fit', lig_gen_fit_struct, lig_struct)
+                self.compute_struct_metrics(row, 'lig', lig_struct)
+                self.compute_struct_metrics(row, 'lig_fit', lig_fit_struct, lig_struct)
+                self.compute_struct_metrics(row, 'lig_gen_fit', lig_gen_fit_struct, lig_struct)
 
                 lig_mol = lig_struct.info['src_mol']
                 lig_add_mol = lig_struct.info['add_mol']
                 lig_fit_add_mol = lig_fit_struct.info['add_mol']
                 lig_gen_fit_add_mol = lig_gen_fit_struct.info['add_mol']
 
-                self.compute_mol_metrics(idx, 'lig', lig_mol)
-                self.compute_mol_metrics(idx, 'lig_add', lig_add_mol, lig_mol)
-                self.compute_mol_metrics(idx, 'lig_fit_add', lig_fit_add_mol, lig_mol)
-                self.compute_mol_metrics(idx, 'lig_gen_fit_add', lig_gen_fit_add_mol, lig_mol)
+                self.compute_mol_metrics(row, 'lig', lig_mol)
+                self.compute_mol_metrics(row, 'lig_add', lig_add_mol, lig_mol)
+                self.compute_mol_metrics(row, 'lig_fit_add', lig_fit_add_mol, lig_mol)
+                self.compute_mol_metrics(row, 'lig_gen_fit_add', lig_gen_fit_add_mol, lig_mol)
+
+            # create any missing columns first (only the first sample
+            # of a run does this) so the row writes in one assignment;
+            # non-numeric values (SMILES, bools, errors) need object
+            # columns- newer pandas raises instead of upcasting float64
+            for col, val in row.items():
+                if col not in self.metrics.columns:
+                    if isinstance(val, (float, int, np.number)) \
+                        and not isinstance(val, (bool, np.bool_)):
+                        self.metrics[col] = np.nan
+                    else:
+                        self.metrics[col] = pd.Series(
+                            np.nan, index=self.metrics.index, dtype=object
+                        )
+
+            self.metrics.loc[idx, list(row)] = list(row.values())
 
         if self.verbose:
             print(self.metrics.loc[lig_name].loc[sample_idxs])
 
-    def compute_grid_metrics(self, idx, grid_type, grid, ref_grid=None, mean_grid=None):
-        m = self.metrics
+    def compute_grid_metrics(self, row, grid_type, grid, ref_grid=None, mean_grid=None):
+
+        # flatten once and reduce with dot products, which reuse the
+        # same terms across metrics instead of allocating a grid-sized
+        # squared-difference temporary for each one
+        gv = np.asarray(grid.values).ravel()
+        gv_dot_gv = np.dot(gv, gv)
 
         # density magnitude
-        m.loc[idx, grid_type+'_norm'] = np.linalg.norm(grid.values)
+        row[grid_type+'_norm'] = np.sqrt(gv_dot_gv)
 
         if mean_grid is not None:
 
-            # density variance
+            # density variance, via ||g - mean||^2 expansion
             # (divide by n_samples (+1) for sample (population) variance)
-            variance = (
-                (grid.values - mean_grid)**2
-            ).sum().item()
+            mv = np.asarray(mean_grid).ravel()
+            variance = gv_dot_gv - 2*np.dot(gv, mv) + np.dot(mv, mv)
         else:
             variance = np.nan
 
-        m.loc[idx, grid_type+'_variance'] = variance
+        row[grid_type+'_variance'] = variance
 
         if ref_grid is not None:
-
-            # density L2 loss
-            m.loc[idx, grid_type+'_L2_loss'] = (
-                (ref_grid.values - grid.values)**2
-            ).sum().item() / 2
-
-            # density L1 loss
-            m.loc[idx, grid_type+'_L1_loss'] = (
-                np.abs(ref_grid.values - grid.values)
-            ).sum().item()
-
-    def compute_latent_metrics(self, idx, latent_type, latent, mean_latent=None):
-        m = self.metrics
-
-        # latent vector magnitude
-        m.loc[idx, latent_type+'_latent_norm'] = np.linalg.norm(latent)
+            rv = np.asarray(ref_grid.values).ravel()
+
+            # density L2 loss, via ||ref - g||^2 expansion
+            row[grid_type+'_L2_loss'] = (
+                np.dot(rv, rv) - 2*np.dot(rv, gv) + gv_dot_gv
+            ) / 2
+
+            # density L1 loss, computed through a reused scratch
+            # buffer - the only grid-sized temporary left here
+            dtype = np.result_type(rv, gv)
+            scratch = self.grid_scratch
+            if scratch is None or scratch.shape != gv.shape \
+                or scratch.dtype != dtype:
+                scratch = self.grid_scratch = np.empty(gv.shape, dtype)
+            np.subtract(rv, gv, out=scratch)
+            np.abs(scratch, out=scratch)
+            row[grid_type+'_L1_loss'] = scratch.sum()
+
+    def compute_latent_metrics(self, row, latent_type, latent, mean_latent=None):
+
+        # latent vector magnitude, via BLAS dot instead of the
+        # generic norm dispatcher
+        lv = np.asarray(latent).ravel()
+        row[latent_type+'_latent_norm'] = np.sqrt(np.dot(lv, lv))
 
         if mean_latent is not None:
 
             # latent vector variance
-            variance = (
-                (latent - mean_latent)**2
-            ).sum()
+            diff = lv - np.asarray(mean_latent).ravel()
+            variance = np.dot(diff, diff)
         else:
             variance = np.nan
 
-        m.loc[idx, latent_type+'_latent_variance'] = variance
+        row[latent_type+'_latent_variance'] = variance
 
-    def compute_struct_metrics(self, idx, struct_type, struct, ref_struct=None):
-        m = self.metrics
+    def compute_struct_metrics(self, row, struct_type, struct, ref_struct=None):
 
         # number of atoms
-        m.loc[idx, struct_type+'_n_atoms'] = struct.n_atoms
+        row[struct_type+'_n_atoms'] = struct.n_atoms
 
         # maximum radius
-        m.loc[idx, struct_type+'_radius'] = struct.radius
+        row[struct_type+'_radius'] = struct.radius
 
         if ref_struct is not None:
 
@@ -1149,12 +1355,9 @@ class OutputWriter(object):
             ref_types = count_types(ref_struct.c, n_types)
 
             # type count difference
-            m.loc[idx, struct_type+'_type_diff'] = np.linalg.norm(
-                ref_types - types, ord=1
-            )
-            m.loc[idx, struct_type+'_exact_types'] = (
-                m.loc[idx, struct_type+'_type_diff'] == 0
-            )
+            type_diff = np.linalg.norm(ref_types - types, ord=1)
+            row[struct_type+'_type_diff'] = type_diff
+            row[struct_type+'_exact_types'] = (type_diff == 0)
 
             # minimum typed-atom RMSD
             try:
@@ -1164,24 +1367,22 @@ class OutputWriter(object):
             except (ValueError, ZeroDivisionError):
                 rmsd = np.nan
 
-            m.loc[idx, struct_type+'_RMSD'] = rmsd
+            row[struct_type+'_RMSD'] = rmsd
 
         if struct_type.endswith('_fit'):
 
             # fit time and number of visited structures
-            m.loc[idx, struct_type+'_time'] = struct.info['time']
-            m.loc[idx, struct_type+'_n_visited'] = len(struct.info['visited_structs'])
+            row[struct_type+'_time'] = struct.info['time']
+            row[struct_type+'_n_visited'] = len(struct.info['visited_structs'])
 
             # accuracy of estimated type counts, whether or not
             # they were actually used to constrain atom fitting
             est_type = struct_type[:-4] + '_est'
-            m.loc[idx, est_type+'_type_diff'] = struct.info.get('est_type_diff', np.nan)
-            m.loc[idx, est_type+'_exact_types'] = (
-                m.loc[idx, est_type+'_type_diff'] == 0
-            )
+            est_type_diff = struct.info.get('est_type_diff', np.nan)
+            row[est_type+'_type_diff'] = est_type_diff
+            row[est_type+'_exact_types'] = (est_type_diff == 0)
 
-    def compute_mol_metrics(self, idx, mol_type, mol, ref_mol=None):
-        m = self.metrics
+    def compute_mol_metrics(self, row, mol_type, mol, ref_mol=None):
 
         # standardize mols
         mol_info = mol.info
@@ -1190,43 +1391,59 @@ class OutputWriter(object):
 
         # check molecular validity
         n_frags, error, valid = get_rd_mol_validity(mol)
-        m.loc[idx, mol_type+'_n_frags'] = n_frags
-        m.loc[idx, mol_type+'_error'] = error
-        m.loc[idx, mol_type+'_valid'] = valid
+        row[mol_type+'_n_frags'] = n_frags
+        row[mol_type+'_error'] = error
+        row[mol_type+'_valid'] = valid
 
         # other molecular descriptors
-        m.loc[idx, mol_type+'_MW'] = get_rd_mol_weight(mol)
-        m.loc[idx, mol_type+'_logP'] = get_rd_mol_logP(mol)
-        m.loc[idx, mol_type+'_QED'] = get_rd_mol_QED(mol)
-        m.loc[idx, mol_type+'_SAS'] = get_rd_mol_SAS(mol)
-        m.loc[idx, mol_type+'_NPS'] = get_rd_mol_NPS(mol, nps_model)
+        row[mol_type+'_MW'] = get_rd_mol_weight(mol)
+        row[mol_type+'_logP'] = get_rd_mol_logP(mol)
+        row[mol_type+'_QED'] = get_rd_mol_QED(mol)
+        row[mol_type+'_SAS'] = get_rd_mol_SAS(mol)
+        row[mol_type+'_NPS'] = get_rd_mol_NPS(mol, nps_model)
 
         # convert to SMILES string
         smi = get_smiles_string(mol)
-        m.loc[idx, mol_type+'_SMILES'] = smi
+        row[mol_type+'_SMILES'] = smi
 
         if ref_mol is not None: # compare to ref_mol
 
             ref_mol_info = ref_mol.info
-            ref_mol = Chem.RemoveHs(ref_mol, sanitize=False)
-            ref_mol.info = ref_mol_info
 
-            # get reference SMILES strings
-            ref_smi = get_smiles_string(ref_mol)
-            m.loc[idx, mol_type+'_SMILES_match'] = (smi == ref_smi)
+            # RemoveHs rebuilds the mol graph, so only standardize
+            # the reference mol once and reuse it across samples
+            # (its info dict is shared by all copies)
+            if 'noH_mol' not in ref_mol_info:
+                noH_mol = Chem.RemoveHs(ref_mol, sanitize=False)
+                noH_mol.info = ref_mol_info
+                ref_mol_info['noH_mol'] = noH_mol
+            ref_mol = ref_mol_info['noH_mol']
+
+            # the same reference mol is compared against every
+            # sample, so cache its SMILES string and fingerprints
+            # in its info dict on the first call
+            if 'smi' not in ref_mol_info:
+                ref_mol_info['smi'] = get_smiles_string(ref_mol)
+                for fp in ['morgan', 'rdkit', 'maccs']:
+                    ref_mol_info[fp+'_fp'] = get_rd_mol_fingerprint(
+                        ref_mol, fp
+                    )
+
+            ref_smi = ref_mol_info['smi']
+            row[mol_type+'_SMILES_match'] = (smi == ref_smi)
 
             # fingerprint similarity
-            m.loc[idx, mol_type+'_ob_sim']  = get_ob_smi_similarity(
+            row[mol_type+'_ob_sim']  = get_ob_smi_similarity(
                 ref_smi, smi
             )
-            m.loc[idx, mol_type+'_morgan_sim'] = get_rd_mol_similarity(
-                ref_mol, mol, 'morgan'
+            row[mol_type+'_morgan_sim'] = get_fingerprint_similarity(
+                ref_mol_info['morgan_fp'], get_rd_mol_fingerprint(mol, 'morgan')
             )
-            m.loc[idx, mol_type+'_rdkit_sim']  = get_rd_mol_similarity(
-                ref_mol, mol, 'rdkit'
+            row[mol_type+'_rdkit_sim']  = get_fingerprint_similarity(
+                ref_mol_info['rdkit_fp'], get_rd_mol_fingerprint(mol, 'rdkit')
             )
-            m.loc[idx, mol_type+'_maccs_sim']  = get_rd_mol_similarity(
-                ref_mol, mol, 'maccs'
+            row[mol_type+'_maccs_sim']  = get_fingerprint_similarity(
+                ref_mol_info['maccs_fp'], get_rd_mol_fingerprint(mol, 'maccs')
             )
 
         # UFF energy minimization
@@ -1234,12 +1451,14 @@ class OutputWriter(object):
         E_init = mol.info['E_init']
         E_min = mol.info['E_min']
 
-        m.loc[idx, mol_type+'_E'] = E_init
-        m.loc[idx, mol_type+'_min_E'] = E_min
-        m.loc[idx, mol_type+'_dE_min'] = E_min - E_init
-        m.loc[idx, mol_type+'_min_error'] = mol.info['min_error']
-        m.loc[idx, mol_type+'_min_time'] = mol.info['min_time']
-        m.loc[idx, mol_type+'_RMSD_min']  = get_aligned_rmsd(min_mol, mol)
+        row[mol_type+'_E'] = E_init
+        row[mol_type+'_min_E'] = E_min
+        row[mol_type+'_dE_min'] = E_min - E_init
+        row[mol_type+'_min_error'] = mol.info['min_error']
+        row[mol_type+'_min_time'] = mol.info['min_time']
+        # minimization preserves atom order, so use the direct
+        # Kabsch RMSD instead of searching atom mappings
+        row[mol_type+'_RMSD_min']  = get_aligned_rmsd_fast(min_mol, mol)
 
         if ref_mol is not None:
 
@@ -1248,14 +1467,14 @@ class OutputWriter(object):
             E_init_ref = ref_mol.info['E_init']
             E_min_ref = ref_mol.info['E_init']
 
-            m.loc[idx, mol_type+'_dE_ref'] = E_init - E_init_ref
-            m.loc[idx, mol_type+'_min_dE_ref'] = E_min - E_min_ref
+            row[mol_type+'_dE_ref'] = E_init - E_init_ref
+            row[mol_type+'_min_dE_ref'] = E_min - E_min_ref
 
             # get aligned RMSD to ref mol, pre-minimize
-            m.loc[idx, mol_type+'_RMSD_ref'] = get_aligned_rmsd(ref_mol, mol)
+            row[mol_type+'_RMSD_ref'] = get_aligned_rmsd(ref_mol, mol)
 
             # get aligned RMSD to true mol, post-minimize
-            m.loc[idx, mol_type+'_min_RMSD_ref'] = get_aligned_rmsd(min_ref_mol, min_mol)
+            row[mol_type+'_min_RMSD_ref'] = get_aligned_rmsd(min_ref_mol, min_mol)
 
 
 def catch_exc(func, exc=Exception, default=np.nan):
@@ -1275,32 +1494,65 @@ get_rd_mol_NPS = catch_exc(npscorer.scoreMol)
 get_aligned_rmsd  = catch_exc(AllChem.GetBestRMS)
 
 
+@catch_exc
+def get_aligned_rmsd_fast(rd_mol1, rd_mol2):
+    '''
+    Kabsch-aligned RMSD for mols whose atoms correspond in order,
+    skipping the atom map enumeration in GetBestRMS. Falls back to
+    GetBestRMS when the atom counts differ (e.g. explicit hydrogens
+    on only one mol).
+    '''
+    n_atoms = rd_mol1.GetNumAtoms()
+    if n_atoms != rd_mol2.GetNumAtoms():
+        return AllChem.GetBestRMS(rd_mol1, rd_mol2)
+    P = rd_mol1.GetConformer().GetPositions()
+    Q = rd_mol2.GetConformer().GetPositions()
+    P = P - P.mean(axis=0)
+    Q = Q - Q.mean(axis=0)
+    U, _, Vt = np.linalg.svd(P.T @ Q)
+    d = np.sign(np.linalg.det(Vt.T @ U.T))
+    R = Vt.T @ np.diag([1.0, 1.0, d]) @ U.T
+    return np.sqrt(((P @ R.T - Q)**2).sum() / n_atoms)
+
+
 @catch_exc
 def get_smiles_string(rd_mol):
     return Chem.MolToSmiles(rd_mol, canonical=True, isomericSmiles=False)
 
 
 @catch_exc
-def get_rd_mol_similarity(rd_mol1, rd_mol2, fingerprint):
+def get_rd_mol_fingerprint(rd_mol, fingerprint):
 
     if fingerprint == 'morgan':
-        fgp1 = AllChem.GetMorganFingerprintAsBitVect(rd_mol1, 2, 1024)
-        fgp2 = AllChem.GetMorganFingerprintAsBitVect(rd_mol2, 2, 1024)
+        return AllChem.GetMorganFingerprintAsBitVect(rd_mol, 2, 1024)
 
     elif fingerprint == 'rdkit':
-        fgp1 = Chem.Fingerprints.FingerprintMols.FingerprintMol(rd_mol1)
-        fgp2 = Chem.Fingerprints.FingerprintMols.FingerprintMol(rd_mol2)
+        return Chem.Fingerprints.FingerprintMols.FingerprintMol(rd_mol)
 
     elif fingerprint == 'maccs':
-        fgp1 = AllChem.GetMACCSKeysFingerprint(rd_mol1)
-        fgp2 = AllChem.GetMACCSKeysFingerprint(rd_mol2)
+        return AllChem.GetMACCSKeysFingerprint(rd_mol)
+
+
+get_fingerprint_similarity = catch_exc(DataStructs.TanimotoSimilarity)
+
 
+@catch_exc
+def get_rd_mol_similarity(rd_mol1, rd_mol2, fingerprint):
+    fgp1 = get_rd_mol_fingerprint(rd_mol1, fingerprint)
+    fgp2 = get_rd_mol_fingerprint(rd_mol2, fingerprint)
     return DataStructs.TanimotoSimilarity(fgp1, fgp2)
 
 
+# the reference smiles is compared against every sample, so cache
+# its openbabel fingerprint by string (one entry per ligand)
+ob_smi_fp_cache = dict()
+
+
 @catch_exc
 def get_ob_smi_similarity(smi1, smi2):
-    fgp1 = pybel.readstring('smi', smi1).calcfp()
+    if smi1 not in ob_smi_fp_cache:
+        ob_smi_fp_cache[smi1] = pybel.readstring('smi', smi1).calcfp()
+    fgp1 = ob_smi_fp_cache[smi1]
     fgp2 = pybel.readstring('smi', smi2).calcfp()
     return fgp1 | fgp2
 
@@ -1396,40 +1648,57 @@ def connect_rd_mol_frags(rd_mol):
     n_frags = len(frags)
     if n_frags > 1:
 
-        nax = np.newaxis
+        n_atoms = rd_mol.GetNumAtoms()
         xyz = rd_mol.GetConformer(0).GetPositions()
-        dist2 = ((xyz[nax,:,:] - xyz[:,nax,:])**2).sum(axis=2)
 
-        pt = Chem.GetPeriodicTable()
-        while n_frags > 1:
-
-            frag_map = {ai: fi for fi, f in enumerate(frags) for ai in f}
-            frag_idx = np.array([frag_map[i] for i in range(rd_mol.GetNumAtoms())])
-            diff_frags = frag_idx[nax,:] != frag_idx[:,nax]
+        # only atom pairs within the 5A cutoff can ever be bonded,
+        # so query them from a k-d tree instead of building the
+        # full n_atoms x n_atoms distance matrix
+        pairs = cKDTree(xyz).query_pairs(r=5.0, output_type='ndarray')
+        a1s, a2s = pairs[:,0], pairs[:,1]
+        pair_dist2 = ((xyz[a1s] - xyz[a2s])**2).sum(axis=1)
 
-            can_bond = []
-            for a in rd_mol.GetAtoms():
-                n_bonds = sum(b.GetBondTypeAsDouble() for b in a.GetBonds())
-                max_bonds = pt.GetDefaultValence(a.GetAtomicNum())
-                can_bond.append(n_bonds < max_bonds)
+        # valence limits don't change as bonds are added,
+        # so compute them once instead of per iteration
+        pt = Chem.GetPeriodicTable()
+        max_bonds = np.array([
+            pt.GetDefaultValence(a.GetAtomicNum())
+            for a in rd_mol.GetAtoms()
+        ])
+        n_bonds = np.array([
+            sum(b.GetBondTypeAsDouble() for b in a.GetBonds())
+            for a in rd_mol.GetAtoms()
+        ])
+
+        # track fragment membership in an index array, updated as
+        # fragments merge, instead of recomputing GetMolFrags and
+        # every atom's bond count on each added bond
+        frag_idx = np.zeros(n_atoms, dtype=int)
+        for fi, f in enumerate(frags):
+            frag_idx[list(f)] = fi
 
-            can_bond = np.array(can_bond)
-            can_bond = can_bond[nax,:] & can_bond[:,nax]
+        while n_frags > 1:
 
-            cond_dist2 = np.where(diff_frags & can_bond & (dist2<25), dist2, np.inf)
+            can_bond = n_bonds < max_bonds
+            valid = (
+                (frag_idx[a1s] != frag_idx[a2s])
+                & can_bond[a1s] & can_bond[a2s]
+            )
 
-            if not np.any(np.isfinite(cond_dist2)):
+            if not valid.any():
                 break # no possible bond meets the conditions
 
-            a1, a2 = np.unravel_index(cond_dist2.argmin(), dist2.shape)
+            p = np.where(valid, pair_dist2, np.inf).argmin()
+            a1, a2 = a1s[p], a2s[p]
             rd_mol.AddBond(int(a1), int(a2), Chem.BondType.SINGLE)
             try:
                 rd_mol.UpdatePropertyCache() # update explicit valences
             except:
                 pass
 
-            frags = Chem.GetMolFrags(rd_mol)
-            n_frags = len(frags)
+            n_bonds[[a1, a2]] += 1
+            frag_idx[frag_idx == frag_idx[a2]] = frag_idx[a1]
+            n_frags -= 1
                   
 
 def find_real_mol_in_data_root(data_root, lig_src_no_ext):
@@ -1461,24 +1730,26 @@ def find_real_mol_in_data_root(data_root, lig_src_no_ext):
 
 def write_latent_vecs_to_file(latent_file, latent_vecs):
 
-    with open(latent_file, 'w') as f:
-        for v in latent_vecs:
-            line = ' '.join('{:.5f}'.format(x) for x in v) + '\n'
-            f.write(line)
+    # savetxt formats rows in C instead of one python
+    # string format call per latent dimension
+    with open(latent_file, 'wb') as f:
+        np.savetxt(f, np.asarray(latent_vecs), fmt='%.5f')
 
 
 def conv_grid(grid, kernel):
     # convolution theorem: g * grid = F-1(F(g)F(grid))
-    F_h = np.fft.fftn(kernel)
-    F_grid = np.fft.fftn(grid)
-    return np.real(np.fft.ifftn(F_grid * F_h))
+    # the inputs are real, so the half-spectrum rfft transforms
+    # do half the work of fftn and need no real-part extraction
+    F_h = np.fft.rfftn(kernel)
+    F_grid = np.fft.rfftn(grid)
+    return np.fft.irfftn(F_grid * F_h, s=grid.shape)
 
 
 def weiner_invert_kernel(kernel, noise_ratio=0.0):
-    F_h = np.fft.fftn(kernel)
+    F_h = np.fft.rfftn(kernel)
     conj_F_h = np.conj(F_h)
     F_g = conj_F_h / (F_h*conj_F_h + noise_ratio)
-    return np.real(np.fft.ifftn(F_g))
+    return np.fft.irfftn(F_g, s=kernel.shape)
 
 
 def wiener_deconv_grid(grid, kernel, noise_ratio=0.0):
@@ -1492,24 +1763,40 @@ def wiener_deconv_grid(grid, kernel, noise_ratio=0.0):
     # take F() to be the Fourier transform, F-1() the inverse Fourier transform
     # convolution theorem: g * grid = F-1(F(g)F(grid))
     # Wiener deconvolution: F(g) = 1/F(h) |F(h)|^2 / (|F(h)|^2 + noise_ratio)
-    F_h = np.fft.fftn(kernel)
-    F_grid = np.fft.fftn(grid)
+    F_h = np.fft.rfftn(kernel)
+    F_grid = np.fft.rfftn(grid)
     conj_F_h = np.conj(F_h)
     F_g = conj_F_h / (F_h*conj_F_h + noise_ratio)
-    return np.real(np.fft.ifftn(F_grid * F_g))
+    return np.fft.irfftn(F_grid * F_g, s=grid.shape)
+
+
+# the Wiener filter of a channel only depends on the kernel params,
+# so cache the filters across calls instead of rebuilding a kernel
+# and its FFT per channel per grid
+wiener_filter_cache = dict()
 
 
 def wiener_deconv_grids(grids, channels, resolution, radius_multiple, noise_ratio=0.0, radius_factor=1.0):
 
     deconv_grids = np.zeros_like(grids)
-    points = get_grid_points(grids.shape[1:], 0, resolution)
+    points = None
 
     for i, grid in enumerate(grids):
 
         r = channels[i].atomic_radius*radius_factor
-        kernel = get_atom_density(resolution/2, r, points, radius_multiple).reshape(grid.shape)
-        kernel = np.roll(kernel, shift=[d//2 for d in grid.shape], axis=range(grid.ndim))
-        deconv_grids[i,...] = wiener_deconv_grid(grid, kernel, noise_ratio)
+        key = (grid.shape, resolution, radius_multiple, noise_ratio, r)
+
+        if key not in wiener_filter_cache:
+            if points is None:
+                points = get_grid_points(grids.shape[1:], 0, resolution)
+            kernel = get_atom_density(resolution/2, r, points, radius_multiple).reshape(grid.shape)
+            kernel = np.roll(kernel, shift=[d//2 for d in grid.shape], axis=range(grid.ndim))
+            F_h = np.fft.rfftn(kernel)
+            conj_F_h = np.conj(F_h)
+            wiener_filter_cache[key] = conj_F_h / (F_h*conj_F_h + noise_ratio)
+
+        F_g = wiener_filter_cache[key]
+        deconv_grids[i,...] = np.fft.irfftn(np.fft.rfftn(grid) * F_g, s=grid.shape)
 
     return np.stack(deconv_grids, axis=0)
 
@@ -1523,7 +1810,9 @@ def get_grid_points(shape, center, resolution):
     center = np.array(center)
     resolution = np.array(resolution)
     origin = center - resolution*(shape - 1)/2.0
-    indices = np.array(list(np.ndindex(*shape)))
+    # build the index array in C instead of looping np.ndindex
+    # over every grid point in python
+    indices = np.indices(shape).reshape(len(shape), -1).T
     return origin + resolution*indices
 
 
@@ -1571,35 +1860,39 @@ def n_lines_in_file(file):
         return sum(1 for line in f)
 
 
-def write_pymol_script(pymol_file, out_prefix, dx_prefixes, sdf_files, centers=[]):
+def write_pymol_script(pymol_file, out_prefix, dx_prefixes, sdf_files, centers=[], mode='w'):
     '''
     Write a pymol script that loads all .dx files with a given
     prefix into a single group, then loads a set of sdf_files
     and translates them to the origin, if centers are provided.
+    Opening with mode='a' appends to an existing script.
     '''
-    with open(pymol_file, 'w') as f:
+    # compile the name patterns once instead of per entry
+    dx_pat = re.compile('^({}_.*)$'.format(out_prefix))
+    sdf_pat = re.compile(r'^({}_.*)\.sdf(\.gz)?$'.format(out_prefix))
+
+    with open(pymol_file, mode) as f:
 
         for dx_prefix in dx_prefixes: # load densities
             dx_pattern = '{}_*.dx'.format(dx_prefix)
-            m = re.match('^({}_.*)$'.format(out_prefix), dx_prefix)
-            group_name = m.group(1) + '_grids'
+            group_name = dx_pat.match(dx_prefix).group(1) + '_grids'
             f.write('load_group {}, {}\n'.format(dx_pattern, group_name))
 
         for sdf_file in sdf_files: # load structures
-            m = re.match(r'^({}_.*)\.sdf(\.gz)?$'.format(out_prefix), sdf_file)
-            obj_name = m.group(1)
+            obj_name = sdf_pat.match(sdf_file).group(1)
             f.write('load {}, {}\n'.format(sdf_file, obj_name))
 
         for sdf_file, (x,y,z) in zip(sdf_files, centers): # center structures
-            m = re.match(r'^({}_.*)\.sdf(\.gz)?$'.format(out_prefix), sdf_file)
-            obj_name = m.group(1)
+            obj_name = sdf_pat.match(sdf_file).group(1)
             f.write('translate [{},{},{}], {}, camera=0, state=0\n'.format(-x, -y, -z, obj_name))
 
 
 def make_one_hot(x, n, dtype=None, device=None):
-    y = torch.zeros(x.shape + (n,), dtype=dtype, device=device)
-    for idx, last_idx in np.ndenumerate(x):
-        y[idx + (int(last_idx),)] = 1
+    # scatter into the last dim instead of assigning one element
+    # at a time from a python loop
+    idx = torch.as_tensor(x, dtype=torch.long, device=device)
+    y = torch.zeros(tuple(x.shape) + (n,), dtype=dtype, device=device)
+    y.scatter_(-1, idx.unsqueeze(-1), 1)
     return y
 
 
@@ -1686,17 +1979,33 @@ def read_examples_from_data_file(data_file, data_root='', n=None):
     return examples
 
 
+@lru_cache(maxsize=None)
+def compile_blob_pattern(blob_pattern):
+    return re.compile('^{}$'.format(blob_pattern), re.MULTILINE)
+
+
+# setup probes the same net for a dozen blob names, so cache the
+# joined name list per net instead of rebuilding it per probe
+net_blob_text_cache = dict()
+
+
 def find_blobs_in_net(net, blob_pattern):
     '''
     Find all blob_names in net that match blob_pattern.
     '''
-    return re.findall('^{}$'.format(blob_pattern), '\n'.join(net.blobs), re.MULTILINE)
+    key = id(net)
+    if key not in net_blob_text_cache:
+        net_blob_text_cache[key] = '\n'.join(net.blobs)
+    return compile_blob_pattern(blob_pattern).findall(
+        net_blob_text_cache[key]
+    )
 
 
 def count_types(c, n_types, dtype=None):
-    count = np.zeros(n_types, dtype=dtype)
-    for i in c:
-        count[i] += 1
+    # bincount tallies the type indices in a single C pass
+    count = np.bincount(np.asarray(c, dtype=np.intp), minlength=n_types)
+    if dtype is not None:
+        count = count.astype(dtype, copy=False)
     return count
 
 
@@ -1728,16 +2037,24 @@ def get_min_rmsd(xyz1, c1, xyz2, c2):
     xyz1 = xyz1[idx1]
     xyz2 = xyz2[idx2]
 
-    # find min rmsd by solving linear sum assignment
-    # problem on squared dist matrix for each type
-    ssd = 0.0
+    # the mapping is forced for a single atom
+    if n_atoms == 1:
+        return np.sqrt(((xyz1 - xyz2)**2).sum())
+
+    # find min rmsd by solving one linear sum assignment problem
+    # over all atoms at once: a single gemm builds every pairwise
+    # squared distance via ||a-b||^2 = ||a||^2 + ||b||^2 - 2 a.b,
+    # and cross-type pairs get a cost too large to ever be chosen,
+    # which avoids a python round trip per type
     nax = np.newaxis
-    for c in set(c1): 
-        xyz1_c = xyz1[c1 == c]
-        xyz2_c = xyz2[c2 == c]
-        dist2_c = ((xyz1_c[:,nax,:] - xyz2_c[nax,:,:])**2).sum(axis=2)
-        idx1, idx2 = sp.optimize.linear_sum_assignment(dist2_c)
-        ssd += dist2_c[idx1, idx2].sum()
+    sq1 = (xyz1*xyz1).sum(axis=1)
+    sq2 = (xyz2*xyz2).sum(axis=1)
+    dist2 = sq1[:,nax] + sq2[nax,:] - 2*np.dot(xyz1, xyz2.T)
+    np.maximum(dist2, 0, out=dist2) # clamp gemm rounding error
+    penalty = n_atoms*dist2.max() + 1
+    dist2[c1[:,nax] != c2[nax,:]] = penalty
+    idx1, idx2 = sp.optimize.linear_sum_assignment(dist2)
+    ssd = dist2[idx1, idx2].sum()
 
     return np.sqrt(ssd/n_atoms)
 
@@ -1747,16 +2064,17 @@ def slerp(v0, v1, t):
     Spherical linear interpolation between
     vectors v0 and v1 at points t.
     '''
-    norm_v0 = np.linalg.norm(v0)
-    norm_v1 = np.linalg.norm(v1)
-    dot_v0_v1 = np.dot(v0, v1)
-    cos_theta = dot_v0_v1 / (norm_v0 * norm_v1)
+    norm_v0 = np.sqrt(np.dot(v0, v0))
+    norm_v1 = np.sqrt(np.dot(v1, v1))
+    cos_theta = np.clip(np.dot(v0, v1) / (norm_v0 * norm_v1), -1.0, 1.0)
     theta = np.arccos(cos_theta)
     sin_theta = np.sin(theta)
-    s0 = np.sin((1.0-t)*theta) / sin_theta
-    s1 = np.sin(t*theta) / sin_theta
-    return s0[:,np.newaxis] * v0[np.newaxis,:] \
-         + s1[:,np.newaxis] * v1[np.newaxis,:]
+    if sin_theta < 1e-6: # nearly parallel, fall back to lerp
+        s0, s1 = 1.0 - t, t
+    else:
+        s0 = np.sin((1.0-t)*theta) / sin_theta
+        s1 = np.sin(t*theta) / sin_theta
+    return np.outer(s0, v0) + np.outer(s1, v1)
 
 
 def generate_from_model(gen_net, data_param, n_examples, args):
@@ -1787,14 +2105,33 @@ def generate_from_model(gen_net, data_param, n_examples, args):
     grid_dims = grid_maker.grid_dimensions(rec_map.num_types() + lig_map.num_types())
     grid_true = torch.zeros(batch_size, *grid_dims, dtype=torch.float32, device=device)
 
+    # keep a pinned host mirror of grid_true, so each batch download
+    # is a DMA copy into the same buffer instead of allocating fresh
+    # pageable memory that the driver must stage
+    if device == 'cuda':
+        grid_host = torch.empty_like(grid_true, device='cpu').pin_memory()
+    else:
+        grid_host = grid_true
+
     print('Finding important blobs')
+
+    # all of the probed names are literal, so one pass over the
+    # net's blob names and set membership tests replace a regex
+    # scan of the full list per probe
+    blob_set = set(gen_net.blobs)
+
+    def find_blob(blob_name):
+        if blob_name not in blob_set:
+            raise IndexError('no blob named ' + repr(blob_name))
+        return blob_name
+
     try: # find receptor encoder blobs
-        rec_enc_start = find_blobs_in_net(gen_net, 'rec')[0]
+        rec_enc_start = find_blob('rec')
         try:
-            rec_enc_end = find_blobs_in_net(gen_net, 'rec_latent_std')[0]
+            rec_enc_end = find_blob('rec_latent_std')
             rec_enc_is_var = True
         except IndexError:
-            rec_enc_end = find_blobs_in_net(gen_net, 'rec_latent_fc')[0]
+            rec_enc_end = find_blob('rec_latent_fc')
             rec_enc_is_var = False
         has_rec_enc = True
     except IndexError:
@@ -1808,15 +2145,15 @@ def generate_from_model(gen_net, data_param, n_examples, args):
             print('\trec_enc_end = {}'.format(repr(rec_enc_end)))
 
     try: # find ligand encoder blobs
-        lig_enc_start = find_blobs_in_net(gen_net, 'lig')[0]
+        lig_enc_start = find_blob('lig')
         try:
-            lig_enc_end = find_blobs_in_net(gen_net, 'lig_latent_std')[0]
+            lig_enc_end = find_blob('lig_latent_std')
             lig_enc_is_var = True
         except IndexError:
             try:
-                lig_enc_end = find_blobs_in_net(gen_net, 'lig_latent_defc')[0]
+                lig_enc_end = find_blob('lig_latent_defc')
             except IndexError:
-                lig_enc_end = find_blobs_in_net(gen_net, 'lig_latent_fc')[0]
+                lig_enc_end = find_blob('lig_latent_fc')
             lig_enc_is_var = False
         has_lig_enc = True
     except IndexError:
@@ -1838,16 +2175,16 @@ def generate_from_model(gen_net, data_param, n_examples, args):
 
     try: # find latent variable blobs
         latent_prefix = ('lig' if has_lig_enc else 'rec') + '_latent'
-        latent_mean = find_blobs_in_net(gen_net, latent_prefix+'_mean')[0]
-        latent_std = find_blobs_in_net(gen_net, latent_prefix+'_std')[0]
-        latent_noise = find_blobs_in_net(gen_net, latent_prefix+'_noise')[0]
-        latent_sample = find_blobs_in_net(gen_net, latent_prefix+'_sample')[0]
+        latent_mean = find_blob(latent_prefix+'_mean')
+        latent_std = find_blob(latent_prefix+'_std')
+        latent_noise = find_blob(latent_prefix+'_noise')
+        latent_sample = find_blob(latent_prefix+'_sample')
         variational = True
     except IndexError:
         try:
-            latent_sample = find_blobs_in_net(gen_net, latent_prefix+'_defc')[0]
+            latent_sample = find_blob(latent_prefix+'_defc')
         except IndexError:
-            latent_sample = find_blobs_in_net(gen_net, latent_prefix+'_fc')[0]
+            latent_sample = find_blob(latent_prefix+'_fc')
         variational = False
 
     if args.verbose:
@@ -1860,17 +2197,28 @@ def generate_from_model(gen_net, data_param, n_examples, args):
 
     # find ligand decoder blobs (required)
     if has_rec_enc and has_lig_enc:
-        lig_dec_start = find_blobs_in_net(gen_net, 'latent_concat')[0]
+        lig_dec_start = find_blob('latent_concat')
     else:
-        lig_dec_start = find_blobs_in_net(gen_net, 'lig_dec_fc')[0]
-    lig_dec_end = find_blobs_in_net(gen_net, 'lig_gen')[0]
+        lig_dec_start = find_blob('lig_dec_fc')
+    lig_dec_end = find_blob('lig_gen')
 
     if args.verbose:
         print('has_lig_dec = True')
         print('\tlig_dec_start = {}'.format(repr(lig_dec_start)))
         print('\tlig_dec_end = {}'.format(repr(lig_dec_end)))
 
-    n_latent = gen_net.blobs[latent_sample].shape[1]
+    # bind the blobs touched every batch once, instead of going
+    # through the pycaffe blob dict inside the generation loop
+    rec_blob = gen_net.blobs['rec']
+    lig_blob = gen_net.blobs['lig']
+    cond_rec_blob = gen_net.blobs['cond_rec'] if 'cond_rec' in blob_set else None
+    latent_sample_blob = gen_net.blobs[latent_sample]
+    if variational:
+        latent_mean_blob = gen_net.blobs[latent_mean]
+        latent_std_blob = gen_net.blobs[latent_std]
+    grid_blobs = {n: gen_net.blobs[n] for n in args.blob_name}
+
+    n_latent = latent_sample_blob.shape[1]
 
     print('Testing generator forward')
     gen_net.forward() # this is necessary for proper latent sampling
@@ -1914,7 +2262,11 @@ def generate_from_model(gen_net, data_param, n_examples, args):
         if args.fit_atoms or args.output_conv:
 
             if args.dkoes_simple_fit:
-                atom_fitter = DkoesAtomFitter(args.dkoes_make_mol, args.use_openbabel)
+                atom_fitter = DkoesAtomFitter(
+                    args.dkoes_make_mol,
+                    args.use_openbabel,
+                    output_visited=args.output_visited,
+                )
             else:
                 atom_fitter = AtomFitter(
                     multi_atom=args.multi_atom,
@@ -1940,6 +2292,7 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                     output_kernel=args.output_kernel,
                     device=device,
                     verbose=args.verbose,
+                    output_visited=args.output_visited,
                 )
 
     # generate density grids from generative model in main thread
@@ -1963,17 +2316,24 @@ def generate_from_model(gen_net, data_param, n_examples, args):
 
                     # convert structures to grids
                     print('Transforming and gridding examples')
-                    for i, ex in enumerate(examples):
-                        transform = molgrid.Transform(
-                            ex.coord_sets[1].center(),
-                            args.random_translate,
-                            args.random_rotation,
-                        )
-                        transform.forward(ex, ex)
-                        grid_maker.forward(ex, grid_true[i])
+                    if args.random_rotation or args.random_translate > 0:
+                        # transform examples in-place so the true structs
+                        # read back later match the gridded coordinates
+                        for i, ex in enumerate(examples):
+                            transform = molgrid.Transform(
+                                ex.coord_sets[1].center(),
+                                args.random_translate,
+                                args.random_rotation,
+                            )
+                            transform.forward(ex, ex)
+                            grid_maker.forward(ex, grid_true[i])
+                    else: # grid the whole batch in one molgrid call
+                        grid_maker.forward(examples, grid_true)
 
-                    rec = grid_true[:,:rec_map.num_types(),...].cpu()
-                    lig = grid_true[:,rec_map.num_types():,...].cpu()
+                    if device == 'cuda':
+                        grid_host.copy_(grid_true)
+                    rec = grid_host[:,:rec_map.num_types(),...]
+                    lig = grid_host[:,rec_map.num_types():,...]
 
                     need_first = (args.encode_first or args.condition_first)
                     is_first = (example_idx == sample_idx == 0)
@@ -1986,54 +2346,57 @@ def generate_from_model(gen_net, data_param, n_examples, args):
 
                     # set encoder input grids
                     if args.encode_first:
-                        gen_net.blobs['rec'].data[...] = first_rec
-                        gen_net.blobs['lig'].data[...] = first_lig
+                        rec_blob.data[...] = first_rec
+                        lig_blob.data[...] = first_lig
                     else:
-                        gen_net.blobs['rec'].data[...] = rec
-                        gen_net.blobs['lig'].data[...] = lig
+                        rec_blob.data[...] = rec
+                        lig_blob.data[...] = lig
 
                     # set conditional input grids
-                    if 'cond_rec' in gen_net.blobs:
+                    if cond_rec_blob is not None:
                         if args.condition_first:
-                            gen_net.blobs['cond_rec'].data[...] = first_rec
+                            cond_rec_blob.data[...] = first_rec
                         else:
-                            gen_net.blobs['cond_rec'].data[...] = rec
+                            cond_rec_blob.data[...] = rec
 
                     if args.interpolate: # interpolate between real grids
 
-                        start_rec = np.array(rec[:1])
-                        start_lig = np.array(lig[:1])
-                        end_rec = np.array(rec[-1:])
-                        end_lig = np.array(lig[-1:])
-
-                        gen_net.blobs['rec'].data[...] = np.linspace(
-                            start_rec, end_rec, batch_size, endpoint=True
-                        )
-                        gen_net.blobs['lig'].data[...] = np.linspace(
-                            start_lig, end_lig, batch_size, endpoint=True
-                        )
+                        # blend the endpoint grids directly into the blob
+                        # buffers with a precomputed weight vector, instead
+                        # of materializing full-batch linspace tensors and
+                        # then copying them in
+                        w = np.linspace(
+                            0.0, 1.0, batch_size, endpoint=True,
+                            dtype=np.float32,
+                        )[:,None,None,None,None]
+                        for blob, grids in ((rec_blob, rec), (lig_blob, lig)):
+                            start = np.asarray(grids[:1])
+                            end = np.asarray(grids[-1:])
+                            blob_data = blob.data
+                            np.multiply(w, end - start, out=blob_data)
+                            np.add(blob_data, start, out=blob_data)
 
                     if has_rec_enc: # forward receptor encoder
                         if rec_enc_is_var:
                             if args.prior:
-                                gen_net.blobs[latent_mean].data[...] = 0.0
-                                gen_net.blobs[latent_std].data[...] = args.var_factor
+                                latent_mean_blob.data[...] = 0.0
+                                latent_std_blob.data[...] = args.var_factor
                             else: # posterior
                                 gen_net.forward(start=rec_enc_start, end=rec_enc_end)
                                 if args.var_factor != 1.0:
-                                    gen_net.blobs[latent_std].data[...] *= args.var_factor
+                                    latent_std_blob.data[...] *= args.var_factor
                         else:
                             gen_net.forward(start=rec_enc_start, end=rec_enc_end)
 
                     if has_lig_enc: # forward ligand encoder
                         if lig_enc_is_var:
                             if args.prior:
-                                gen_net.blobs[latent_mean].data[...] = 0.0
-                                gen_net.blobs[latent_std].data[...] = args.var_factor
+                                latent_mean_blob.data[...] = 0.0
+                                latent_std_blob.data[...] = args.var_factor
                             else: # posterior
                                 gen_net.forward(start=lig_enc_start, end=lig_enc_end)
                                 if args.var_factor != 1.0:
-                                    gen_net.blobs[latent_std].data[...] *= args.var_factor
+                                    latent_std_blob.data[...] *= args.var_factor
                         else:
                             gen_net.forward(start=lig_enc_start, end=lig_enc_end)
 
@@ -2042,18 +2405,18 @@ def generate_from_model(gen_net, data_param, n_examples, args):
 
                     if args.interpolate: # interpolate between latent samples
 
-                        latent = gen_net.blobs[latent_sample].data
+                        latent = latent_sample_blob.data
                         start_latent = np.array(latent[0])
                         end_latent = np.array(latent[-1])
 
                         if args.spherical:
-                            gen_net.blobs[latent_sample].data[...] = slerp(
+                            latent_sample_blob.data[...] = slerp(
                                 start_latent,
                                 end_latent,
                                 np.linspace(0, 1, batch_size, endpoint=True)
                             )
                         else:
-                            gen_net.blobs[latent_sample].data[...] = np.linspace(
+                            latent_sample_blob.data[...] = np.linspace(
                                 start_latent, end_latent, batch_size, endpoint=True
                             )
 
@@ -2070,7 +2433,7 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                 lig_coord_set = ex.coord_sets[1]
                 lig_src = lig_coord_set.src
                 lig_struct = AtomStruct.from_coord_set(lig_coord_set, lig_channels)
-                types = count_types(lig_struct.c, lig_map.num_types(), dtype=np.int16)
+                types = lig_struct.type_counts(lig_map.num_types(), dtype=np.int16)
 
                 lig_src_no_ext = os.path.splitext(lig_src)[0]
                 lig_name = os.path.basename(lig_src_no_ext)
@@ -2090,7 +2453,7 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                         atom_fitter.validify(lig_struct)
 
                 # get latent vector for current example
-                latent_vec = np.array(gen_net.blobs[latent_sample].data[batch_idx])
+                latent_vec = np.array(latent_sample_blob.data[batch_idx])
 
                 # get data from blob, process, and write output
                 for blob_name in args.blob_name:
@@ -2100,7 +2463,7 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                         continue
 
                     grid_type = blob_name
-                    grid_blob = gen_net.blobs[blob_name]
+                    grid_blob = grid_blobs[blob_name]
                     grid_needs_fit = args.fit_atoms and blob_name in {'lig', 'lig_gen'}
 
                     if blob_name == 'rec':
@@ -2136,9 +2499,16 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                         ), flush=True)
 
                     if args.output_conv:
+                        # wrap the values without copying and stage them
+                        # in pinned memory so the upload is async
+                        values = torch.from_numpy(
+                            np.ascontiguousarray(grid.values, dtype=np.float32)
+                        )
+                        if atom_fitter.device == 'cuda':
+                            values = values.pin_memory()
                         grid.info['conv_grid'] = grid.new_like(
                             values=atom_fitter.convolve(
-                                torch.tensor(grid.values, device=atom_fitter.device),
+                                values.to(atom_fitter.device, non_blocking=True),
                                 grid.channels,
                                 grid.resolution,
                             ).cpu().detach().numpy()
@@ -2147,7 +2517,13 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                     if args.parallel:
                         out_queue.put((lig_name, grid_type, sample_idx, grid))
                         if grid_needs_fit:
-                            fit_queue.put((lig_name, grid_type, sample_idx, grid, types))
+                            # send fit grids as float16 to halve the pickle
+                            # and pipe traffic; the fitting tolerances are
+                            # far above fp16 quantization error
+                            fit_grid = grid.new_like(
+                                values=grid.values.astype(np.float16)
+                            )
+                            fit_queue.put((lig_name, grid_type, sample_idx, fit_grid, types))
                     else:
                         out_writer.write(lig_name, grid_type, sample_idx, grid)
                         if grid_needs_fit:
@@ -2174,6 +2550,7 @@ def fit_worker_main(fit_queue, out_queue, args):
         atom_fitter = DkoesAtomFitter(
             dkoes_make_mol=args.dkoes_make_mol,
             use_openbabel=args.use_openbabel,
+            output_visited=args.output_visited,
         )
     else:
         atom_fitter = AtomFitter(
@@ -2200,6 +2577,7 @@ def fit_worker_main(fit_queue, out_queue, args):
             output_kernel=args.output_kernel,
             device='cpu', # can't fit on gpu in multiple threads
             verbose=args.verbose,
+            output_visited=args.output_visited,
         )
 
     while True:
@@ -2215,7 +2593,11 @@ def fit_worker_main(fit_queue, out_queue, args):
         if args.verbose:
             print('Fit worker got {} {} {}'.format(lig_name, grid_type, sample_idx))
 
-        out_queue.put((lig_name, grid_type, sample_idx, grid))
+        # restore full precision after the fp16 queue hand-off; don't
+        # re-put the input grid- the main thread already sent the
+        # full-precision copy to the output queue
+        if grid.values.dtype != np.float32:
+            grid = grid.new_like(values=grid.values.astype(np.float32))
 
         grid = atom_fitter.fit(grid, types)
         grid_type = grid_type + '_fit'
@@ -2258,7 +2640,9 @@ def out_worker_main(out_queue, args):
         print('Output worker exit')
 
 
-def parse_args(argv=None):
+_parser = None
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Generate atomic density grids from generative model with Caffe')
     parser.add_argument('-d', '--data_model_file', required=True, help='prototxt file for data model')
     parser.add_argument('-g', '--gen_model_file', required=True, help='prototxt file for generative model')
@@ -2319,7 +2703,16 @@ def parse_args(argv=None):
     parser.add_argument('--parallel', default=False, action='store_true', help='run atom fitting in separate worker processes')
     parser.add_argument('--n_fit_workers', default=8, type=int, help='number of worker processes for parallel atom fitting')
     parser.add_argument('--gen_only',action='store_true',help='Only produce generated molecules; do not perform fitting on true ligand')
-    return parser.parse_args(argv)
+    return parser
+
+
+def parse_args(argv=None):
+    # build the parser once so repeated calls from a batch driver
+    # don't redo the add_argument setup
+    global _parser
+    if _parser is None:
+        _parser = build_parser()
+    return _parser.parse_args(argv)
 
 
 def main(argv):
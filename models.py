@@ -66,8 +66,7 @@ def write_models(model_dir, param_space, scaffold=False, n_benchmark=0, verbose=
     '''
     Write a model in model_dir for every set of params in param_space.
     '''
-    if not os.path.isdir(model_dir):
-        os.makedirs(model_dir)
+    os.makedirs(model_dir, exist_ok=True)
 
     if scaffold or n_benchmark > 0:
         df = pd.DataFrame(index=range(len(param_space)))
@@ -1,4 +1,4 @@
-import gzip
+import io, gzip
 import numpy as np
 from rdkit import Chem, Geometry
 from openbabel import openbabel as ob
@@ -17,25 +17,27 @@ def make_rd_mol(xyz, c, bonds, channels):
     n_atoms = rd_mol.GetNumAtoms()
     rd_conf = Chem.Conformer(n_atoms)
 
-    for i, (x, y, z) in enumerate(xyz):
+    #unbox the coordinates to python floats in one tolist call
+    #instead of binding numpy scalars per atom
+    for i, (x, y, z) in enumerate(np.asarray(xyz, dtype=np.float64).tolist()):
         rd_conf.SetAtomPosition(i, (x, y, z))
 
     rd_mol.AddConformer(rd_conf)
 
-    if np.any(bonds):
-        n_bonds = 0
-        for i in range(n_atoms):
-            for j in range(i+1, n_atoms):
-                if bonds[i,j]:
-                    rd_mol.AddBond(i, j, Chem.BondType.SINGLE)
-                    n_bonds += 1
+    #find the bonded upper-triangle pairs in numpy so python only
+    #loops over the actual bonds
+    ii, jj = np.nonzero(np.triu(np.asarray(bonds), k=1))
+    for i, j in zip(ii.tolist(), jj.tolist()):
+        rd_mol.AddBond(i, j, Chem.BondType.SINGLE)
 
     return rd_mol
 
 
 def read_rd_mols_from_sdf_file(sdf_file):
     if sdf_file.endswith('.gz'):
-        f = gzip.open(sdf_file)
+        #buffer the decompressed stream so the supplier reads in
+        #large chunks instead of line-sized gzip reads
+        f = io.BufferedReader(gzip.open(sdf_file), buffer_size=256*1024)
         suppl = Chem.ForwardSDMolSupplier(f)
     else:
         suppl = Chem.SDMolSupplier(sdf_file)
@@ -64,38 +66,38 @@ def make_ob_mol(xyz, c, bonds, channels):
     ob_mol = ob.OBMol()
 
     n_atoms = 0
-    for (x, y, z), c_ in zip(xyz, c):
+    for (x, y, z), c_ in zip(np.asarray(xyz, dtype=np.float64).tolist(), c):
         atomic_num = channels[c_].atomic_num
         atom = ob_mol.NewAtom()
         atom.SetAtomicNum(atomic_num)
         atom.SetVector(x, y, z)
         n_atoms += 1
 
-    if np.any(bonds):
-        n_bonds = 0
-        for i in range(n_atoms):
-            atom_i = ob_mol.GetAtom(i)
-            for j in range(i+1, n_atoms):
-                atom_j = ob_mol.GetAtom(j)
-                if bonds[i,j]:
-                    bond = ob_mol.NewBond()
-                    bond.Set(n_bonds, atom_i, atom_j, 1, 0)
-                    n_bonds += 1
+    n_bonds = 0
+    ii, jj = np.nonzero(np.triu(np.asarray(bonds), k=1))
+    for i, j in zip(ii.tolist(), jj.tolist()):
+        bond = ob_mol.NewBond()
+        bond.Set(n_bonds, ob_mol.GetAtom(i), ob_mol.GetAtom(j), 1, 0)
+        n_bonds += 1
     return ob_mol
 
 
 def write_ob_mols_to_sdf_file(sdf_file, mols):
     conv = ob.OBConversion()
+    conv.SetOutFormat('sdf')
     if sdf_file.endswith('.gz'):
-        conv.SetOutFormat('sdf.gz')
+        #compress at level 1; sdf text compresses well at any level
+        #and openbabel's default level 6 is much slower to write
+        with gzip.open(sdf_file, 'wt', compresslevel=1) as f:
+            for mol in mols:
+                f.write(conv.WriteString(mol))
     else:
-        conv.SetOutFormat('sdf')
-    for i, mol in enumerate(mols):
-        if i == 0:
-            conv.WriteFile(mol, sdf_file)
-        else:
-            conv.Write(mol)
-    conv.CloseOutFile()
+        for i, mol in enumerate(mols):
+            if i == 0:
+                conv.WriteFile(mol, sdf_file)
+            else:
+                conv.Write(mol)
+        conv.CloseOutFile()
 
 
 def rd_mol_to_ob_mol(rd_mol):
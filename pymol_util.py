@@ -7,30 +7,52 @@ import isoslider
 import atom_types
 
 
-def set_atom_level(level, selection='*', state=None, rec_map=None, lig_map=None):
+#the channel table, colors, and dx regex are the same on every call
+#with the same map files, so build them once per (rec_map, lig_map)
+_channel_cache = {}
 
-    if rec_map is None:
-        rec_channels = atom_types.get_default_rec_channels()
-    else:
-        rec_channels = atom_types.get_channels_from_file(rec_map, name_prefix='Receptor')
+def get_channel_info(rec_map=None, lig_map=None):
 
-    if lig_map is None:
-        lig_channels = atom_types.get_default_lig_channels()
-    else:
-        lig_channels = atom_types.get_channels_from_file(lig_map, name_prefix='Ligand')
+    key = (rec_map, lig_map)
+    if key not in _channel_cache:
+
+        if rec_map is None:
+            rec_channels = atom_types.get_default_rec_channels()
+        else:
+            rec_channels = atom_types.get_channels_from_file(rec_map, name_prefix='Receptor')
+
+        if lig_map is None:
+            lig_channels = atom_types.get_default_lig_channels()
+        else:
+            lig_channels = atom_types.get_channels_from_file(lig_map, name_prefix='Ligand')
 
-    channels = rec_channels + lig_channels
-    channels_by_name = dict((c.name, c) for c in channels)
+        channels = rec_channels + lig_channels
+        channels_by_name = dict((c.name, c) for c in channels)
 
-    for c in channels:
-        cmd.set_color(c.name+'$', atom_types.get_channel_color(c))
+        for c in channels:
+            cmd.set_color(c.name+'$', atom_types.get_channel_color(c))
 
-    dx_regex = re.compile(r'(.*)_(\d+)_({})\.dx'.format('|'.join(channels_by_name)))
+        dx_regex = re.compile(r'(.*)_(\d+)_({})\.dx'.format('|'.join(channels_by_name)))
+        _channel_cache[key] = (channels_by_name, dx_regex)
+
+    return _channel_cache[key]
+
+
+def set_atom_level(level, selection='*', state=None, rec_map=None, lig_map=None):
+
+    channels_by_name, dx_regex = get_channel_info(rec_map, lig_map)
+
+    #compile the selection pattern once instead of fnmatching every
+    #object name, and skip the check entirely for the default '*'
+    if selection == '*':
+        sel_match = None
+    else:
+        sel_match = re.compile(fnmatch.translate(selection)).match
 
     surface_groups = OrderedDict()
     for dx_object in sorted(cmd.get_names('objects')):
 
-        if not fnmatch.fnmatch(dx_object, selection):
+        if sel_match is not None and not sel_match(dx_object):
             continue
 
         m = dx_regex.match(dx_object)
@@ -10,8 +10,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from rdkit.Geometry.rdGeometry import Point3D
 from skimage.segmentation import flood_fill
-from scipy.spatial.distance import pdist
-from scipy.spatial.distance import squareform
+from scipy.spatial import cKDTree
 
 import generate
 import atom_types
@@ -24,6 +23,10 @@ gmaker = molgrid.GridMaker(gaussian_radius_multiple=-1.5,dimension=36)
 
 device = 'cuda'
 
+#per-element openbabel max bond counts indexed by atomic number,
+#built once at import so the per-atom loop reduces to a numpy gather
+_ob_max_bonds = np.array([openbabel.GetMaxBonds(z) for z in range(119)])
+
 
 def grid_to_xyz(gcoords, mgrid):
     return mgrid.center+(np.array(gcoords)-((mgrid.size-1)/2))*mgrid.resolution
@@ -336,26 +339,26 @@ def fixup(atoms, mol, struct):
                 atom.SetAromatic(True)
 
 
-def reachable_r(a,b, seenbonds):
-    '''Recursive helper.'''
-
-    for nbr in openbabel.OBAtomAtomIter(a):
-        bond = a.GetBond(nbr).GetIdx()
-        if bond not in seenbonds:
-            seenbonds.add(bond)
-            if nbr == b:
-                return True
-            elif reachable_r(nbr,b,seenbonds):
-                return True
-    return False
-        
 def reachable(a,b):
     '''Return true if atom b is reachable from a without using the bond between them.'''
     if a.GetExplicitDegree() == 1 or b.GetExplicitDegree() == 1:
         return False #this is the _only_ bond for one atom
-    #otherwise do recursive traversal
+    #otherwise do an iterative traversal with an explicit stack, which
+    #avoids recursion depth limits and per-call overhead; compare atom
+    #indices rather than swig proxies and stop as soon as b is found
     seenbonds = set([a.GetBond(b).GetIdx()])
-    return reachable_r(a,b,seenbonds)
+    b_idx = b.GetIdx()
+    stack = [a]
+    while stack:
+        cur = stack.pop()
+        for nbr in openbabel.OBAtomAtomIter(cur):
+            bond = cur.GetBond(nbr).GetIdx()
+            if bond not in seenbonds:
+                seenbonds.add(bond)
+                if nbr.GetIdx() == b_idx:
+                    return True
+                stack.append(nbr)
+    return False
 
 def forms_small_angle(a,b,cutoff=45):
     '''Return true if bond between a and b is part of a small angle
@@ -380,43 +383,75 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
     mol.BeginModify()
 
 
-    #just going to to do n^2 comparisons, can worry about efficiency later
-    coords = np.array([(a.GetX(),a.GetY(),a.GetZ()) for a in atoms])
-    dists = squareform(pdist(coords))
+    #keep the condensed distance vector and extract the qualifying
+    #pairs up front, so python only loops over actual candidate bonds
+    #float32 halves the bandwidth of the pairwise distance math below
+    coords = np.array([(a.GetX(),a.GetY(),a.GetZ()) for a in atoms], dtype=np.float32)
     types = [struct.channels[t].name for t in struct.c]
-    
-    for (i,a) in enumerate(atoms):
-        for (j,b) in enumerate(atoms):
-            if a == b:
-                break
-            if dists[i,j] < 0.4:
-                continue #don't bond too close atoms
-            if dists[i,j] < maxbond:
-                flag = 0
-                if 'Aromatic' in types[i] and 'Aromatic' in types[j]:
-                    flag = openbabel.OB_AROMATIC_BOND
-                mol.AddBond(a.GetIdx(),b.GetIdx(),1,flag)
+    idxs = [a.GetIdx() for a in atoms]
+    is_aromatic = ['Aromatic' in t for t in types]
+
+    #a kd-tree query only returns pairs within the max bond length,
+    #so the work scales with the candidate count instead of n^2
+    pairs = cKDTree(coords).query_pairs(r=maxbond, output_type='ndarray')
+    d2 = ((coords[pairs[:,0]] - coords[pairs[:,1]])**2).sum(axis=1)
+    #unbox the surviving pairs to python ints in one tolist call
+    for i, j in pairs[d2 >= 0.4**2].tolist(): #don't bond too close atoms
+        flag = 0
+        if is_aromatic[i] and is_aromatic[j]:
+            flag = openbabel.OB_AROMATIC_BOND
+        mol.AddBond(idxs[i],idxs[j],1,flag)
+
+    #read each atom's element once; the accessors are swig calls
+    atomic_nums = np.array([a.GetAtomicNum() for a in atoms])
 
     #cleanup = remove long bonds
+    maxb_all = _ob_max_bonds[atomic_nums] #don't exceed this
     atom_maxb = {}
     for (i,a) in enumerate(atoms):
-        maxb = openbabel.GetMaxBonds(a.GetAtomicNum()) #don't exceed this
+        maxb = int(maxb_all[i])
         if 'Donor' in types[i]:
             maxb -= 1 #leave room for hydrogen
-        atom_maxb[a.GetIdx()] = maxb
-    
+        atom_maxb[idxs[i]] = maxb
+
+    #look up each element's covalent radius once instead of per bond
+    covalent_rad = {z: openbabel.GetCovalentRad(z) for z in set(atomic_nums)}
+
     bonds = [b for b in openbabel.OBMolBondIter(mol)]
-    binfo = []
-    for bond in bonds:
-        bdist = bond.GetLength()
-        #compute how far away from optimal we are
-        a1 = bond.GetBeginAtom()
-        a2 = bond.GetEndAtom()
-        ideal = openbabel.GetCovalentRad(a1.GetAtomicNum()) + openbabel.GetCovalentRad(a2.GetAtomicNum()) 
-        stretch = bdist-ideal
-        binfo.append((stretch,bdist,bond))
-    binfo.sort(reverse=True) #most stretched bonds first
+    #compute how far away from optimal we are as arrays, then sort
+    #with one vectorized lexsort instead of python tuple compares
+    if bonds:
+        bdists = np.array([b.GetLength() for b in bonds])
+        ideals = np.array([
+            covalent_rad[b.GetBeginAtom().GetAtomicNum()]
+            + covalent_rad[b.GetEndAtom().GetAtomicNum()]
+            for b in bonds
+        ])
+        stretches = bdists - ideals
+        order = np.lexsort((-bdists, -stretches)) #most stretched bonds first
+        binfo = [(stretches[k], bdists[k], bonds[k]) for k in order]
+    else:
+        binfo = []
     
+    #atom positions never change during cleanup (only bonds are
+    #deleted), so test the small-angle condition against the cached
+    #coordinates with one vectorized cosine per atom instead of a
+    #GetAngle call per neighbor
+    pos = np.zeros((max(idxs)+1, 3) if idxs else (1, 3), dtype=np.float32)
+    pos[idxs] = coords
+    cos_cutoff = np.cos(np.radians(45))
+
+    def forms_small_angle_np(a, b):
+        a_idx = a.GetIdx()
+        b_idx = b.GetIdx()
+        nbrs = [n.GetIdx() for n in openbabel.OBAtomAtomIter(a) if n.GetIdx() != b_idx]
+        if not nbrs:
+            return False
+        v1 = pos[b_idx] - pos[a_idx]
+        V = pos[nbrs] - pos[a_idx]
+        cos = (V @ v1) / (np.linalg.norm(V, axis=1)*np.linalg.norm(v1))
+        return bool((cos > cos_cutoff).any())
+
     for stretch,bdist,bond in binfo:
         #can we remove this bond without disconnecting the molecule?
         a1 = bond.GetBeginAtom()
@@ -432,7 +467,7 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
         if stretch > 0.45 or  \
             a1.GetExplicitValence() > atom_maxb[a1.GetIdx()] or \
             a2.GetExplicitValence() > atom_maxb[a2.GetIdx()] or \
-            forms_small_angle(a1,a2) or forms_small_angle(a2,a1):
+            forms_small_angle_np(a1,a2) or forms_small_angle_np(a2,a1):
             mol.DeleteBond(bond)
             continue                        
             
@@ -12,8 +12,7 @@ def write_solvers(solver_dir, param_space, print_=False):
     '''
     Write a solver in solver_dir for every param assignment in param_space.
     '''
-    if not os.path.isdir(solver_dir):
-        os.makedirs(solver_dir)
+    os.makedirs(solver_dir, exist_ok=True)
 
     for solver_params in param_space:
         solver_file = os.path.join(solver_dir, '{}.solver'.format(solver_params))